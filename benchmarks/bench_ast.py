@@ -0,0 +1,129 @@
+"""Benchmark of loading saved parse trees against parsing.
+
+Generates a synthetic exam and a question bank of the given size, then
+times parsing every section and question against loading them from the
+binary data transpile saves in .examtex-cache (and next to banks).
+Also checks that sections loaded after lines were added above them
+report the lines they are now at.
+
+    python3 benchmarks/bench_ast.py [--questions N] [--repeat N]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import examtex  # noqa: E402
+import gen_exam  # noqa: E402
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench_exam(lines, path, repeat):
+    """Times getting every section of an exam already scanned (which
+    both need, to hash the sections)."""
+    exam = examtex.Exam(lines, lazy=True)
+
+    def parse():
+        exam.sections = [None] * len(exam.spans)
+        exam.asts = {}
+        for i in range(len(exam.spans)):
+            exam.section(i)
+
+    parse()
+    examtex.save_ast(exam.to_data(), path)
+
+    def load():
+        saved = examtex.load_ast(path)
+        exam.sections = [None] * len(exam.spans)
+        exam.asts = {digest: data for _, digest, data in saved["sections"]}
+        for i in range(len(exam.spans)):
+            exam.section(i)
+
+    return timed(parse, repeat), timed(load, repeat)
+
+
+def check_shifted(lines, path):
+    """Checks that the sections saved in path, loaded once lines are
+    added above each of them, are those parsing the new file gives,
+    line numbers included."""
+    saved = examtex.load_ast(path)
+    asts = {digest: data for _, digest, data in saved["sections"]}
+    shifted = []
+    for line in lines:
+        if examtex.Exam.header_ptrn.match(line):
+            shifted += ["\n", "\n"]
+        shifted.append(line)
+    loaded = examtex.Exam(shifted, asts=asts)
+    parsed = examtex.Exam(shifted)
+    if loaded.reparsed:
+        sys.exit("sections were parsed again after lines were added")
+    if loaded.to_data(absolute=True) != parsed.to_data(absolute=True):
+        sys.exit("sections loaded after lines were added report the "
+                 "wrong lines")
+
+
+def bench_bank(path, repeat):
+    def parse():
+        bank = examtex.Bank(path)
+        bank.ast_path += ".unused"
+        bank.load_ast()
+        for i in range(len(bank.offsets)):
+            bank.load([i], examtex.MC)
+
+    def load(drawn):
+        bank = examtex.Bank(path)
+        bank.load(drawn, examtex.MC)
+
+    bank = examtex.Bank(path)
+    everything = list(range(len(bank.offsets)))
+    # saves every question parsed
+    bank.load(everything, examtex.MC)
+    return (timed(parse, repeat), timed(lambda: load(everything), repeat),
+            timed(lambda: load(everything[::len(everything) // 50]),
+                  repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--questions", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    lines = gen_exam.generate(args.questions)
+    rng = random.Random(0)
+    bank_lines = ["[MC]\n"]
+    for i in range(args.questions):
+        bank_lines.append("@Tags:: t{}\n".format(i % 10))
+        bank_lines.append(gen_exam.sentence(rng, 15) + "?\n")
+        for j in range(4):
+            bank_lines.append("    " + gen_exam.sentence(rng, 4) + "\n")
+    with tempfile.TemporaryDirectory() as tmp:
+        exam_path = os.path.join(tmp, "a.ast")
+        exam_parse, exam_load = bench_exam(lines, exam_path, args.repeat)
+        check_shifted(lines, exam_path)
+        bank_path = os.path.join(tmp, "questions.bank")
+        with open(bank_path, 'w') as fileout:
+            fileout.writelines(bank_lines)
+        bank_parse, bank_load, bank_draw = bench_bank(bank_path, args.repeat)
+    print("{} questions, median of {}".format(args.questions, args.repeat))
+    print("exam: parse {:8.1f} ms   load {:8.1f} ms   {:5.1f}x".format(
+        exam_parse * 1000, exam_load * 1000, exam_parse / exam_load))
+    print("bank: parse {:8.1f} ms   load {:8.1f} ms   {:5.1f}x".format(
+        bank_parse * 1000, bank_load * 1000, bank_parse / bank_load))
+    print("bank: load 50 drawn {:6.1f} ms".format(bank_draw * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+"""Benchmark of rendering an exam to HTML pages against tex.
+
+Generates a synthetic exam of each size, parses it, then times rendering
+all of its documents for a seed: as HTML pages with render_html, and as
+tex with render_version (without the cache). Neither includes parsing,
+nor compiling the tex, which takes pdflatex seconds more.
+
+    python3 benchmarks/bench_html.py [--questions N ...] [--repeat N]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import examtex  # noqa: E402
+import gen_exam  # noqa: E402
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--questions", type=int, nargs="+",
+                        default=[50, 500, 5000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print("median of {}".format(args.repeat))
+    for questions in args.questions:
+        lines = gen_exam.generate(questions, answer_sheet=True)
+        exam = examtex.Exam(lines)
+        for i in range(len(exam.spans)):
+            exam.section(i)
+        html = timed(lambda: examtex.render_html(exam, "1"), args.repeat)
+        tex = timed(lambda: examtex.render_version(exam, "1"), args.repeat)
+        print("{:6} questions: html {:8.1f} ms   tex {:8.1f} ms".format(
+            questions, html * 1000, tex * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""Micro-benchmark for examtex.latexify.
+
+Compares the current latexify against the original rescanning
+implementation on a long Text module and a large MC bank, checks that both
+give identical output, and prints throughput in lines and MB per second.
+
+    python3 benchmarks/bench_latexify.py [--lines N] [--questions N]
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import examtex  # noqa: E402
+
+
+def legacy_latexify(line):
+    """latexify as originally written, rescanning after every quote."""
+    line = line.replace("%", "\\%")
+    match = re.search("\"[^\"]*\"", line)
+    while match:
+        repl = "``{}''".format(match.group(0)[1:-1])
+        line = line[:match.start()] + repl + line[match.end():]
+        match = re.search("\"[^\"]*\"", line)
+    match = re.search("\\s'[^']+'\\s", line)
+    while match:
+        repl = "`{}'".format(match.group(0)[2:-2])
+        line = line[:match.start()+1] + repl + line[match.end()-1:]
+        match = re.search("\\s'[^']+'\\s", line)
+    line = re.sub(r"\\i\s*{", r"\\textit{", line)
+    line = re.sub(r"\\b\s*{", r"\\textbf{", line)
+    return line
+
+
+WORDS = ["the", "star", "galaxy", "50%", "\\b{bold}", "\\i{it}", "$m_B$",
+         "\"quoted phrase\"", "'single'", "don't", "cluster", "redshift"]
+
+
+def text_module(rng, lines):
+    """Long paragraphs, as found in Text modules and FRQ answers."""
+    return [" ".join(rng.choice(WORDS) for _ in range(60))
+            for _ in range(lines)]
+
+
+def mc_bank(rng, questions):
+    """Question and choice strings of a large MC bank. Choices repeat
+    heavily, as they do in real banks."""
+    strings = []
+    for _ in range(questions):
+        strings.append(" ".join(rng.choice(WORDS) for _ in range(15)))
+        strings += [rng.choice(["True", "False", "None of the above",
+                                "All of the above"]),
+                    " ".join(rng.choice(WORDS) for _ in range(4)),
+                    " ".join(rng.choice(WORDS) for _ in range(4)),
+                    rng.choice(["\"Yes\"", "'No'"])]
+    return strings
+
+
+def bench(name, fn, strings, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        if hasattr(fn, "cache_clear"):
+            fn.cache_clear()
+        start = time.perf_counter()
+        for s in strings:
+            fn(s)
+        best = min(best, time.perf_counter() - start)
+    size = sum(map(len, strings)) / 1e6
+    print("{:<28} {:>9.1f} ms {:>12.0f} lines/s {:>8.1f} MB/s".format(
+        name, best * 1e3, len(strings) / best, size / best))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--lines", type=int, default=5000)
+    parser.add_argument("--questions", type=int, default=5000)
+    args = parser.parse_args()
+    rng = random.Random(0)
+    cases = [("text module", text_module(rng, args.lines)),
+             ("mc bank", mc_bank(rng, args.questions))]
+    for case, strings in cases:
+        for s in strings:
+            if legacy_latexify(s) != examtex.latexify(s):
+                sys.exit("Output mismatch on {!r}".format(s))
+        print("{} ({} strings)".format(case, len(strings)))
+        old = bench("  legacy", legacy_latexify, strings)
+        new = bench("  latexify", examtex.latexify, strings)
+        print("  speedup: {:.1f}x".format(old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Benchmark of the language server's response to a keystroke.
+
+Opens a synthetic exam and a question bank of the given size in examlsp,
+then times typing a character into a question in the middle of each:
+updating the document and computing its diagnostics, as the server does
+for every edit. Also times opening the document, which parses all of
+it, getting the outline after a keystroke, and a hover.
+
+    python3 benchmarks/bench_lsp.py [--questions N] [--repeat N]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import examlsp  # noqa: E402
+import gen_exam  # noqa: E402
+
+
+def timed(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def bench(path, text, repeat):
+    """Returns the median times of opening the document, a keystroke, a
+    keystroke and the outline, and a hover in it."""
+    doc = examlsp.Document("file://" + path, text)
+    # a question line in the middle: not indented, and not a header,
+    # option, module or bang
+    middle = len(doc.lines) // 2
+    line = next(i for i in range(middle, len(doc.lines))
+                if doc.lines[i][:1].isalpha()
+                and "::" not in doc.lines[i])
+    position = {"line": line, "character": 0}
+
+    def keystroke():
+        doc.change({"range": {"start": position, "end": position},
+                    "text": "x"})
+        doc.diagnostics()
+
+    return (timed(lambda: examlsp.Document("file://" + path, text),
+                  max(1, repeat // 10)),
+            timed(keystroke, repeat),
+            timed(lambda: keystroke() or doc.symbols(), repeat),
+            timed(lambda: doc.hover(line), repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--questions", type=int, default=2500)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+    rng = random.Random(0)
+    bank = ["[MC]\n"]
+    for i in range(args.questions):
+        bank.append("@Tags:: t{}\n".format(i % 10))
+        bank.append(gen_exam.sentence(rng, 15) + "?\n")
+        for j in range(2):
+            bank.append("    " + gen_exam.sentence(rng, 4) + "\n")
+    exam = "".join(gen_exam.generate(args.questions))
+    with tempfile.TemporaryDirectory() as tmp:
+        results = [
+            ("exam", exam.count("\n"),
+             bench(os.path.join(tmp, "bench.exam"), exam, args.repeat)),
+            ("bank", len(bank),
+             bench(os.path.join(tmp, "bench.bank"), "".join(bank),
+                   args.repeat))]
+    print("{} questions, median of {}".format(args.questions, args.repeat))
+    for name, lines, (opened, key, outline, hover) in results:
+        print("{}: {:6} lines  open {:7.1f} ms  keystroke {:5.2f} ms  "
+              "with outline {:5.2f} ms  hover {:5.2f} ms".format(
+                  name, lines, opened * 1000, key * 1000, outline * 1000,
+                  hover * 1000))
+
+
+if __name__ == "__main__":
+    main()
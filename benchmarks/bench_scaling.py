@@ -0,0 +1,132 @@
+"""Scaling benchmark for the examtex transpiler.
+
+Generates synthetic exams of increasing size with gen_exam.py and times
+each stage separately: parse (Exam.__init__), render (every section's
+to_tex and ans_sheet_tex) and write (streaming the fragments into the
+EXAM and ANS_SHEET sinks). Normally rendering and writing are
+interleaved; here the fragments are collected first. Peak memory is
+measured with tracemalloc in a separate, untimed pass. Results are saved
+as JSON so runs can be compared.
+
+    python3 benchmarks/bench_scaling.py [--sizes 10,100,...] [-o FILE]
+        [--compare OLD.json]
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+import examtex  # noqa: E402
+import gen_exam  # noqa: E402
+
+STAGES = ["parse", "render", "write"]
+
+
+def run(lines, outdir):
+    """Transpiles lines into outdir. Returns the seconds spent in each
+    stage and the number of tex bytes produced."""
+    examtex.latexify.cache_clear()
+    times = {}
+    start = time.perf_counter()
+    exam = examtex.Exam(lines)
+    times["parse"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fragments = list(exam.render(0))
+    times["render"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sinks = [examtex.Sink(os.path.join(outdir, "EXAM.tex"))]
+    if exam.meta["answer sheet"]:
+        sinks.append(examtex.Sink(os.path.join(outdir, "ANS_SHEET.tex"),
+                                  "sheet"))
+    for sink in sinks:
+        sink.begin(exam)
+    for frag in fragments:
+        for sink in sinks:
+            sink.add(frag)
+    for sink in sinks:
+        sink.close()
+    times["write"] = time.perf_counter() - start
+    return times, sum(os.path.getsize(s.filename) for s in sinks)
+
+
+def peak_memory(lines, outdir):
+    tracemalloc.start()
+    run(lines, outdir)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10,100,1000,10000,50000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--answer-sheet", action="store_true")
+    parser.add_argument("-o", "--output", default="bench_scaling.json")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+
+    old = {}
+    if args.compare:
+        with open(args.compare, 'r') as filein:
+            old = {r["questions"]: r for r in json.load(filein)["results"]}
+
+    header = "{:>9} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "questions", "lines", "parse ms", "render ms", "write ms",
+        "peak MB", "tex MB")
+    print(header + ("   vs old" if old else ""))
+    results = []
+    with tempfile.TemporaryDirectory() as outdir:
+        for size in sizes:
+            lines = gen_exam.generate(size, answer_sheet=args.answer_sheet)
+            best = {stage: float("inf") for stage in STAGES}
+            for _ in range(args.repeat):
+                times, tex_bytes = run(lines, outdir)
+                for stage in STAGES:
+                    best[stage] = min(best[stage], times[stage])
+            result = {"questions": size, "lines": len(lines),
+                      "tex_bytes": tex_bytes,
+                      "peak_bytes": peak_memory(lines, outdir)}
+            result.update({stage + "_s": best[stage] for stage in STAGES})
+            results.append(result)
+            row = "{:>9} {:>9} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.1f} " \
+                  "{:>10.1f}".format(size, len(lines), best["parse"] * 1e3,
+                                     best["render"] * 1e3,
+                                     best["write"] * 1e3,
+                                     result["peak_bytes"] / 2**20,
+                                     tex_bytes / 2**20)
+            if size in old:
+                total = sum(best.values())
+                old_total = sum(old[size][s + "_s"] for s in STAGES)
+                row += "   {:.2f}x".format(old_total / total)
+            print(row)
+
+    report = {"commit": git_commit(), "time": time.time(),
+              "python": platform.python_version(),
+              "answer_sheet": args.answer_sheet, "results": results}
+    with open(args.output, 'w') as fileout:
+        json.dump(report, fileout, indent=2)
+    print("Saved results to " + args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Cold start benchmark for examtex.
+
+Imports examtex.py in a fresh interpreter under `python -X importtime`
+and times the `examtex` wrapper transpiling docs/example/MIT.exam.
+Exits nonzero if the import pulls in a heavy module or takes longer than
+--max-import-ms, so it can guard against startup regressions.
+
+    python3 benchmarks/bench_startup.py [--runs N] [--max-import-ms MS]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+# modules that must stay off the transpile path
+HEAVY = ["numpy", "argparse", "subprocess", "concurrent.futures"]
+
+
+def environ():
+    env = dict(os.environ)
+    # measure the usual case, where bytecode is cached
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    return env
+
+
+def import_time():
+    """Returns (cumulative microseconds, imported module names) for
+    importing examtex in a fresh interpreter."""
+    cmd = [sys.executable, "-X", "importtime", "-c", "import examtex"]
+    proc = subprocess.run(cmd, cwd=ROOT, env=environ(), check=True,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    total = None
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = [f.strip() for f in line[len("import time:"):].split("|")]
+        if not fields[1].isdigit():
+            continue
+        name = fields[2]
+        modules.append(name)
+        if name == "examtex":
+            total = int(fields[1])
+    return total, modules
+
+
+def wrapper_time(runs):
+    """Returns wall times of the examtex wrapper transpiling MIT.exam."""
+    times = []
+    with tempfile.TemporaryDirectory() as tmp:
+        shutil.copy(os.path.join(ROOT, "docs", "example", "MIT.exam"), tmp)
+        cmd = [sys.executable, os.path.join(ROOT, "examtex"),
+               os.path.join(tmp, "MIT.exam")]
+        for _ in range(runs + 1):
+            start = time.perf_counter()
+            subprocess.run(cmd, env=environ(), check=True,
+                           stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+    # the first run writes bytecode caches
+    return times[1:]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-import-ms", type=float, default=30.0)
+    args = parser.parse_args()
+    import_time()
+    samples = [import_time() for _ in range(args.runs)]
+    import_ms = statistics.median(s[0] for s in samples) / 1e3
+    modules = samples[0][1]
+    times = wrapper_time(args.runs)
+    print("import examtex:     {:7.1f} ms (median of {})".format(
+        import_ms, args.runs))
+    print("examtex MIT.exam:   {:7.1f} ms (median of {})".format(
+        statistics.median(times) * 1e3, args.runs))
+    failed = False
+    heavy = [m for m in modules if m.split(".")[0] in HEAVY
+             or m in HEAVY]
+    if heavy:
+        print("FAIL: heavy imports on the transpile path: " +
+              ", ".join(sorted(set(heavy))))
+        failed = True
+    if import_ms > args.max_import_ms:
+        print("FAIL: import took longer than {} ms".format(
+            args.max_import_ms))
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
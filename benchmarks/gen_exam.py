@@ -0,0 +1,135 @@
+"""Synthetic .exam generator for benchmarks.
+
+Writes an exam with the requested number of questions spread over [mc],
+[tf], [match] and [frq] sections, with {text}, {latex} and {image}
+modules and bangs mixed in, and FRQs nested down to subsubparts.
+
+    python3 benchmarks/gen_exam.py QUESTIONS [-o FILE] [--seed N]
+        [--answer-sheet]
+"""
+import argparse
+import random
+
+WORDS = ("star galaxy nebula redshift parallax quasar luminosity orbit "
+         "cluster spectrum \"flux\" 'halo' 50% $m_B$ \\b{bold} \\i{it}"
+         ).split()
+SECTION_SIZE = 50
+
+
+def sentence(rng, n):
+    return " ".join(rng.choice(WORDS) for _ in range(n))
+
+
+def modules(rng, indent=""):
+    """A random module or bang, indented by indent."""
+    kind = rng.randrange(5)
+    if kind == 0:
+        return [indent + "{Text}",
+                indent + "    " + sentence(rng, 30),
+                indent + "    " + sentence(rng, 20)]
+    if kind == 1:
+        return [indent + "{Latex}",
+                indent + "    \\begin{itemize}",
+                indent + "        \\item " + sentence(rng, 8),
+                indent + "    \\end{itemize}"]
+    if kind == 2:
+        return [indent + "{Image}",
+                indent + "    width:: 50%",
+                indent + "    -----",
+                indent + "    images/img{}.png".format(rng.randrange(20))]
+    return [indent + rng.choice(["!newpage", "!hrule", "!gap 0.2in"])]
+
+
+def mc(rng, n):
+    lines = ["[MC]", "Name:: Multiple choice",
+             "Twocolumn:: {}".format(rng.choice(["True", "False"])),
+             "Condense:: {}".format(rng.choice(["True", "False"])),
+             "-----"]
+    for _ in range(n):
+        lines.append(sentence(rng, 15) + "?")
+        correct = rng.randrange(5)
+        for j in range(4):
+            choice = "    " + sentence(rng, 4)
+            lines.append(choice + (" {C}" if j == correct else ""))
+        if rng.random() < 0.05:
+            lines += modules(rng)
+    return lines
+
+
+def tf(rng, n):
+    lines = ["[TF]"]
+    for _ in range(n):
+        lines.append("{}:: {}".format(rng.choice(["T", "F", "True"]),
+                                      sentence(rng, 12)))
+        if rng.random() < 0.05:
+            lines += modules(rng)
+    return lines
+
+
+def match(rng, n):
+    lines = ["[Match]", "Name:: Matching", "-----"]
+    bank = [sentence(rng, 2).replace("::", "") for _ in range(20)]
+    for _ in range(n):
+        lines.append("{}:: {}".format(rng.choice(bank), sentence(rng, 10)))
+    return lines
+
+
+def frq_part(rng, level, depth):
+    indent = "    " * level
+    lines = ["{}{{{}}} {}".format(indent, rng.randint(1, 5),
+                                  sentence(rng, 12))]
+    if level < depth:
+        for _ in range(rng.randint(2, 3)):
+            lines += frq_part(rng, level + 1, depth)
+        if rng.random() < 0.1:
+            lines += modules(rng, indent + "    ")
+    else:
+        lines.append("{}    // {{{}}} {}".format(indent, rng.randint(1, 4),
+                                                 sentence(rng, 20)))
+    return lines
+
+
+def frq(rng, n):
+    lines = ["[FRQ]", "Name:: Free response", "-----"]
+    for _ in range(n):
+        lines += frq_part(rng, 0, rng.randrange(4))
+        if rng.random() < 0.05:
+            lines += modules(rng)
+    return lines
+
+
+def generate(questions, seed=0, answer_sheet=False):
+    """Returns the lines of an exam with the given number of questions."""
+    rng = random.Random(seed)
+    lines = ["[Meta]",
+             "Header:: Synthetic;; Benchmark;; Name",
+             "Answer sheet:: {}".format(answer_sheet),
+             "[Cover]",
+             "Title:: Synthetic exam",
+             "ID:: Name;; Number"]
+    lines += modules(rng)
+    kinds = [mc, tf, match, frq]
+    remaining = questions
+    i = 0
+    while remaining > 0:
+        n = min(SECTION_SIZE, remaining)
+        lines += kinds[i % len(kinds)](rng, n)
+        remaining -= n
+        i += 1
+    return [line + "\n" for line in lines]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("questions", type=int)
+    parser.add_argument("-o", "--output", default="synthetic.exam")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--answer-sheet", action="store_true")
+    args = parser.parse_args()
+    with open(args.output, 'w') as fileout:
+        fileout.writelines(generate(args.questions, args.seed,
+                                    args.answer_sheet))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""Builds the pdfs of every exam in a course, rebuilding only those that
+are out of date.
+
+    examtex build DIR [-j N] [-s SEED] [--versions N]
+        [--shuffle-questions] [--force] [--dry-run]
+
+Finds the .exam files under DIR and records in DIR/.examtex-cache/
+course.json what each one's documents were built from: the .exam file,
+template.tex, the transpiler, the question banks, images, image sheet
+and local packages it uses, and its seed and options. An exam is
+rebuilt once one of these changes or one of its pdfs is missing. Files
+are compared by contents, but only read when their size or modification
+time changed. The exams that are out of date are transpiled in a pool of
+N processes, and each one's documents are compiled with latexmk, N at a
+time, as soon as it is transpiled. Prints which exams were rebuilt and
+why.
+"""
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import (ProcessPoolExecutor, ThreadPoolExecutor,
+                                as_completed)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import examtex  # noqa: E402
+
+builddir = ".examtex-build"
+
+
+def find_exams(root):
+    """Returns the paths of the .exam files under root, relative to it,
+    leaving out hidden directories such as the caches."""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for name in sorted(filenames):
+            if name.endswith(".exam"):
+                found.append(os.path.relpath(os.path.join(dirpath, name),
+                                             root))
+    return found
+
+
+def stamp(path):
+    """Returns [modification time, size] of the file at path, or None if
+    there is none."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def digest(path):
+    with open(path, 'rb') as filein:
+        return hashlib.sha256(filein.read()).hexdigest()
+
+
+def dependencies(exam, filename):
+    """Returns the paths of the files the documents of exam, transpiled
+    from filename, were built from, including images not found."""
+    filedir = os.path.dirname(filename)
+    paths = [filename, examtex.template_path, examtex.__file__]
+    paths += exam.banks
+    images = list(exam.images)
+    if exam.meta["image sheet"]:
+        images.append(exam.meta["image sheet"])
+    for img in images:
+        path = os.path.join(filedir, img)
+        paths.append(examtex.find_image(path) or path)
+    for pkg in exam.meta.get("packages", []):
+        for name in pkg.split(","):
+            sty = os.path.join(filedir, name.strip() + ".sty")
+            if os.path.isfile(sty):
+                paths.append(sty)
+    paths = [os.path.abspath(p) for p in paths]
+    return sorted(set(paths), key=paths.index)
+
+
+def transpile_exam(filename, options):
+    """Transpiles the exam at filename with the keyword arguments of
+    examtex.transpile in options. Runs in a worker process. Returns (tex
+    files written, {input path: [modification time, size, sha256], or
+    None if it is missing}), or the ExamError raised."""
+    try:
+        exam = examtex.transpile(filename, **options)
+    except examtex.ExamError as e:
+        return e
+    inputs = {}
+    for path in dependencies(exam, filename):
+        found = stamp(path)
+        inputs[path] = found and found + [digest(path)]
+    return exam.written, inputs
+
+
+class Manifest:
+    """What the documents of each exam in a course were built from, as
+    saved in course.json: {exam: {"options": ..., "inputs": {path:
+    [modification time, size, sha256] or null}, "outputs": [pdf, ...]}},
+    with paths relative to the course directory."""
+
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, ".examtex-cache", "course.json")
+        try:
+            with open(self.path, 'r') as filein:
+                self.exams = json.load(filein)["exams"]
+        except (OSError, ValueError, KeyError):
+            self.exams = {}
+
+    def name(self, path):
+        """Returns how a path is printed: relative to the course directory,
+        or just its file name if it is outside it."""
+        rel = os.path.relpath(path, self.root)
+        return os.path.basename(path) if rel.startswith("..") else rel
+
+    def reasons(self, exam, options):
+        """Returns why the documents of exam are out of date, or [] if they
+        are not. Files touched but unchanged get their new stamp."""
+        entry = self.exams.get(exam)
+        if entry is None:
+            return ["new"]
+        if entry["options"] != options:
+            changed = sorted(k for k in options
+                             if options[k] != entry["options"].get(k))
+            return [", ".join(k.replace("_", " ") for k in changed) +
+                    " changed"]
+        reasons = []
+        for rel, saved in entry["inputs"].items():
+            path = os.path.join(self.root, rel)
+            found = stamp(path)
+            if saved is None:
+                if found is not None:
+                    reasons.append(self.name(path) + " added")
+            elif found is None:
+                reasons.append(self.name(path) + " removed")
+            elif found != saved[:2]:
+                if found[1] == saved[1] and digest(path) == saved[2]:
+                    entry["inputs"][rel] = found + saved[2:]
+                else:
+                    reasons.append(self.name(path) + " changed")
+        for rel in entry["outputs"]:
+            if not os.path.isfile(os.path.join(self.root, rel)):
+                reasons.append(rel + " missing")
+        return reasons
+
+    def record(self, exam, options, inputs, tex_files):
+        self.exams[exam] = {
+            "options": options,
+            "inputs": {os.path.relpath(p, self.root): found
+                       for p, found in inputs.items()},
+            "outputs": [os.path.relpath(f[:-4] + ".pdf", self.root)
+                        for f in tex_files]}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        exams = {exam: self.exams[exam] for exam in sorted(self.exams)}
+        with open(self.path + ".tmp", 'w') as fileout:
+            json.dump({"version": 1, "exams": exams}, fileout, indent=1)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def build(root, jobs=None, seed=None, versions=1, shuffle_questions=False,
+          force=False, dry_run=False):
+    """Rebuilds the pdfs of the exams under root that are out of date (all
+    of them if force), transpiling them in jobs processes and running up
+    to jobs latexmk jobs at once (one per CPU by default). If dry_run,
+    only prints what would be rebuilt. Returns the number of exams that
+    failed."""
+    start = time.perf_counter()
+    jobs = jobs or os.cpu_count() or 1
+    root = os.path.abspath(root)
+    manifest = Manifest(root)
+    exams = find_exams(root)
+    # only the exams still in the course are kept
+    manifest.exams = {e: manifest.exams[e] for e in exams
+                      if e in manifest.exams}
+    options = {}
+    stale = []
+    for exam in exams:
+        filename = os.path.join(root, exam)
+        options[exam] = {"seed": seed or examtex.default_seed(filename),
+                         "versions": versions,
+                         "shuffle_questions": shuffle_questions}
+        reasons = ["forced"] if force else \
+            manifest.reasons(exam, options[exam])
+        if reasons:
+            stale.append(exam)
+            if len(reasons) > 3:
+                reasons[2:] = ["{} more".format(len(reasons) - 2)]
+            print("{}: {}".format(exam, ", ".join(reasons)))
+    if dry_run or not stale:
+        if not dry_run:
+            manifest.save()
+        print("{} of {} exams out of date.".format(len(stale), len(exams)))
+        return 0
+
+    failed = []
+    # a single transpile runs next to latexmk in this process
+    transpiler = ProcessPoolExecutor(jobs) if jobs > 1 and len(stale) > 1 \
+        else ThreadPoolExecutor(1)
+    try:
+        with transpiler, ThreadPoolExecutor(jobs) as latex:
+            pending = {transpiler.submit(transpile_exam,
+                                         os.path.join(root, exam),
+                                         options[exam]): exam
+                       for exam in stale}
+            compiling = []
+            for job in as_completed(pending):
+                exam = pending[job]
+                result = job.result()
+                if isinstance(result, examtex.ExamError):
+                    print("{}: transpile failed".format(exam))
+                    examtex.report_error(result, sys.stdout)
+                    failed.append(exam)
+                    manifest.exams.pop(exam, None)
+                    continue
+                tex_files, inputs = result
+                compiling.append((exam, tex_files, inputs, [
+                    latex.submit(examtex.compile_tex, f, builddir)
+                    for f in tex_files]))
+            for exam, tex_files, inputs, results in compiling:
+                results = [job.result() for job in results]
+                secs = sum(secs for _, secs, _ in results)
+                broken = [(f, log) for f, (code, _, log)
+                          in zip(tex_files, results) if code != 0]
+                for tex_file, log in broken:
+                    print(log.rstrip())
+                    print("{}: {} failed".format(
+                        exam, os.path.basename(tex_file)))
+                if broken:
+                    failed.append(exam)
+                    manifest.exams.pop(exam, None)
+                    continue
+                manifest.record(exam, options[exam], inputs, tex_files)
+                print("{}: built {} documents ({:.2f}s of latexmk)".format(
+                    exam, len(tex_files), secs))
+    finally:
+        manifest.save()
+    print("Rebuilt {} of {} exams in {:.2f}s{}.".format(
+        len(stale) - len(failed), len(exams), time.perf_counter() - start,
+        ", {} failed".format(len(failed)) if failed else ""))
+    return len(failed)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="examtex build",
+                                     description="examtex course build")
+    parser.add_argument("directory")
+    parser.add_argument("-j", "--jobs", type=int)
+    parser.add_argument("-s", "--seed")
+    parser.add_argument("--versions", type=int, default=1)
+    parser.add_argument("--shuffle-questions", action="store_true")
+    parser.add_argument("--force", action="store_true")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args(argv)
+    if not os.path.isdir(args.directory):
+        print("Invalid directory: " + args.directory)
+        sys.exit(1)
+    if build(args.directory, args.jobs, args.seed, args.versions,
+             args.shuffle_questions, args.force, args.dry_run):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
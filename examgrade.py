@@ -0,0 +1,156 @@
+"""Grades student responses against an answer key exported with
+--export-key.
+
+    python3 examgrade.py NAME-KEY.csv responses.csv [-o PREFIX]
+
+responses.csv has a header row. Its first column identifies the student,
+an optional "version" column gives the version each student took (A, B,
+...), and every other column is named after a question number and holds
+the student's answer letter. Questions with a letter answer in the key
+(MC, TF, Match) are graded, each worth its points in the key or 1, and
+those without a column count as unanswered.
+Writes PREFIX-scores.csv with each student's total and
+PREFIX-questions.csv with per-question statistics. Requires NumPy.
+"""
+import csv
+import sys
+
+
+def normalize(answer):
+    answer = answer.strip().upper()
+    return {"TRUE": "T", "FALSE": "F"}.get(answer, answer)
+
+
+def read_key(path):
+    """Returns {version: {question number: (answer, points)}} for the
+    questions with a letter answer."""
+    key = {}
+    with open(path, 'r', newline='') as filein:
+        for row in csv.DictReader(filein):
+            if not row["answer"]:
+                continue
+            points = float(row["points"]) if row["points"] else 1.0
+            key.setdefault(row["version"], {})[int(row["question"])] = \
+                (normalize(row["answer"]), points)
+    return key
+
+
+def grade(key, header, rows):
+    """Scores the response rows (lists of strings under header) against
+    key. All students of a version are graded at once by comparing their
+    responses to that version's answers as arrays. Returns (scores,
+    questions): per student (id, version, score, max score), and per
+    version and question (answer, points, students, fraction correct,
+    fraction blank, discrimination), where discrimination is the
+    correlation between answering the question correctly and the total
+    score. Questions of the key without a column in header, and columns
+    missing from short rows, count as unanswered. Raises ImportError
+    without NumPy, and ValueError if the versions of the responses are
+    missing or not in the key."""
+    try:
+        import numpy as np
+    except ImportError as e:
+        raise ImportError("Grading requires NumPy (pip install numpy).") \
+            from e
+    lower = [h.strip().lower() for h in header]
+    version_col = lower.index("version") if "version" in lower else None
+    columns = [(i, int(h)) for i, h in enumerate(lower)
+               if i > 0 and h.isdigit()]
+    keyed = set(num for answers in key.values() for num in answers)
+    # questions of the key without a column, which no one answered
+    columns += [(None, num) for num in
+                sorted(keyed - set(num for _, num in columns))]
+    numbers = [num for _, num in columns]
+    responses = np.array([[normalize(row[i])
+                           if i is not None and i < len(row) else ""
+                           for i, _ in columns] for row in rows],
+                         dtype=str).reshape(len(rows), len(columns))
+    if version_col is None:
+        if len(key) != 1:
+            raise ValueError("Responses need a version column for a key "
+                             "with several versions.")
+        versions = np.array([next(iter(key))] * len(rows), dtype=object)
+    else:
+        versions = np.array([row[version_col].strip().upper()
+                             if version_col < len(row) else ""
+                             for row in rows], dtype=object)
+    unknown = set(versions) - set(key)
+    if unknown:
+        raise ValueError("Versions not in the key: " + ", ".join(
+            sorted(v or "(blank)" for v in unknown)))
+
+    totals = np.zeros(len(rows))
+    maxima = np.zeros(len(rows))
+    questions = []
+    for version, answers in sorted(key.items()):
+        mask = versions == version
+        expected = np.array([answers.get(num, ("", 0.0))[0]
+                             for num in numbers], dtype=str)
+        points = np.array([answers.get(num, ("", 0.0))[1]
+                           for num in numbers])
+        given = responses[mask]
+        correct = (given == expected) & (expected != "")
+        scores = correct @ points
+        totals[mask] = scores
+        maxima[mask] = points.sum()
+        if not mask.any():
+            continue
+        hits = correct.astype(float)
+        spread = hits.std(axis=0) * scores.std()
+        covariance = ((hits - hits.mean(axis=0)) *
+                      (scores - scores.mean())[:, None]).mean(axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            discrimination = np.where(spread > 0, covariance / spread,
+                                      np.nan)
+        rate = hits.mean(axis=0)
+        blank = (given == "").mean(axis=0)
+        for j, num in enumerate(numbers):
+            if num in answers:
+                questions.append((version, num, expected[j], points[j],
+                                  int(mask.sum()), rate[j], blank[j],
+                                  discrimination[j]))
+    scores = [(row[0], versions[i], totals[i], maxima[i])
+              for i, row in enumerate(rows)]
+    return scores, questions
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="examtex grader")
+    parser.add_argument("key")
+    parser.add_argument("responses")
+    parser.add_argument("-o", "--output", default="grades")
+    args = parser.parse_args(argv)
+    key = read_key(args.key)
+    with open(args.responses, 'r', newline='') as filein:
+        reader = csv.reader(filein)
+        header = next(reader)
+        rows = [row for row in reader if row]
+    try:
+        scores, questions = grade(key, header, rows)
+    except (ImportError, ValueError) as e:
+        print(e)
+        sys.exit(1)
+
+    with open(args.output + "-scores.csv", 'w', newline='') as fileout:
+        writer = csv.writer(fileout)
+        writer.writerow(["student", "version", "score", "max", "percent"])
+        for student, version, score, most in scores:
+            percent = 100 * score / most if most else 0
+            writer.writerow([student, version, "{:g}".format(score),
+                             "{:g}".format(most), "{:.1f}".format(percent)])
+    with open(args.output + "-questions.csv", 'w', newline='') as fileout:
+        writer = csv.writer(fileout)
+        writer.writerow(["version", "question", "answer", "points",
+                         "students", "correct", "blank", "discrimination"])
+        for version, num, answer, points, n, rate, blank, disc in questions:
+            writer.writerow([version, num, answer, "{:g}".format(points), n,
+                             "{:.3f}".format(rate), "{:.3f}".format(blank),
+                             "" if disc != disc else "{:.3f}".format(disc)])
+    print("Graded {} students on {} questions.".format(
+        len(scores), len(set(num for _, num, *_ in questions))))
+    print("Wrote {0}-scores.csv and {0}-questions.csv".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,582 @@
+"""A language server for .exam files and question banks, for the VS Code
+extension in vscode-syntax-extension/ or any editor that speaks the
+Language Server Protocol.
+
+    python3 examlsp.py
+
+Talks JSON-RPC over stdin and stdout. Each open document is kept parsed
+in memory in units: the sections of an exam, or the questions of a bank
+(with the @ lines before each). An edit re-parses only the units it
+touches, so the server keeps up with typing even in banks of thousands
+of questions. It publishes the problems --check reports as diagnostics,
+outlines the sections and numbered questions, and shows the answer to
+the question under the mouse: for MC, TF and Match questions the letter
+as examtex builds the exam with its default seed, and the answers of FRQ
+questions and their points.
+"""
+import bisect
+import json
+import os
+import random
+import re
+import sys
+from urllib.parse import unquote, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import examtex  # noqa: E402
+
+# LSP constants
+SYNC_INCREMENTAL = 2
+SEVERITY_ERROR = 1
+SYMBOL_NAMESPACE = 3
+SYMBOL_FIELD = 8
+METHOD_NOT_FOUND = -32601
+INTERNAL_ERROR = -32603
+
+pool_ptrn = re.compile(r"(?im)^\s*pool\s*::")
+
+
+def uri_path(uri):
+    parsed = urlparse(uri)
+    if parsed.scheme != "file":
+        return parsed.path
+    return os.path.abspath(unquote(parsed.path))
+
+
+def column(line, character):
+    """Returns the index in line of the UTF-16 offset character, which is
+    how the protocol counts columns."""
+    if line.isascii():
+        return character
+    units = 0
+    for i, ch in enumerate(line):
+        if units >= character:
+            return i
+        units += 2 if ord(ch) > 0xFFFF else 1
+    return len(line)
+
+
+class Unit:
+    """The lines [start, end) of a document, parsed on their own. Line
+    numbers in errors and positions (see examtex.Source) count from 1 at
+    start + offset, so that the unit can move without being parsed
+    again."""
+    __slots__ = ("start", "end", "text", "offset", "errors", "positions",
+                 "section", "count", "span", "shuffled", "outline")
+
+    def __init__(self, start, end, text):
+        self.start = start
+        self.end = end
+        self.text = text
+        self.offset = 0
+        self.errors = []
+        self.positions = []
+        # the parsed section of an exam, if it parsed
+        self.section = None
+        # the questions the section adds to the exam's numbering
+        self.count = 0
+        # whether the exam renders the section (see Exam.spans)
+        self.span = False
+        # the (seed, position) the section was last shuffled for
+        self.shuffled = None
+        # ((start, number before it), (symbols, number after it))
+        self.outline = None
+
+    def line(self, lineno):
+        """Returns the line in the document of the line number lineno."""
+        return self.start + (lineno or 1) - 1 - self.offset
+
+
+class Document:
+    """An open .exam file or question bank, as units (see Unit)."""
+
+    def __init__(self, uri, text):
+        self.uri = uri
+        self.path = uri_path(uri)
+        self.basedir = os.path.dirname(self.path)
+        self.bank = self.path.endswith(".bank")
+        self.seed = examtex.default_seed(self.path)
+        self.lines = text.splitlines(True)
+        self.units = []
+        # the first nonblank line, which is the header of a bank
+        self.header = None
+        self.header_text = None
+        self.rescan()
+
+    def rescan(self):
+        """Splits the whole document into units again, reusing those whose
+        text is unchanged."""
+        old = {unit.text: unit for unit in self.units}
+        header = next((i for i, line in enumerate(self.lines)
+                       if line.strip()), len(self.lines))
+        text = self.lines[header] if header < len(self.lines) else ""
+        if self.bank and text != self.header_text:
+            # questions are parsed as the type the header gives
+            old = {}
+        self.header, self.header_text = header, text
+        self.units = self.scan(0, len(self.lines), old)
+
+    def starts(self, start, stop):
+        """Returns where the units in lines [start, stop) begin, given that
+        one begins at start."""
+        lines = self.lines
+        if not self.bank:
+            return [start] + [i for i in range(start + 1, stop)
+                              if "[" in lines[i]
+                              and examtex.Exam.header_ptrn.match(lines[i])]
+        # in a bank, a question starts at its first @ line or its first
+        # line, and the first starts after the header
+        k = start - 1
+        while k >= 0 and lines[k].strip() == "":
+            k -= 1
+        option = k >= 0 and lines[k].startswith("@")
+        found = [start]
+        for i in range(start, stop):
+            line = lines[i]
+            if line.strip() == "":
+                continue
+            if i > max(start, self.header) and not option and \
+                    not line[0].isspace():
+                found.append(i)
+            option = line.startswith("@")
+        return found
+
+    def scan(self, start, stop, old):
+        """Returns the units of lines [start, stop), taken from old (units
+        by text) where their text is unchanged and parsed otherwise. Each
+        unit of old is taken once, even if others have its text."""
+        if start >= stop:
+            return []
+        bounds = self.starts(start, stop) + [stop]
+        units = []
+        for first, end in zip(bounds, bounds[1:]):
+            text = "".join(self.lines[first:end])
+            unit = old.pop(text, None)
+            # the questions of a bank are parsed after its header
+            offset = 1 if self.bank and first > self.header else 0
+            if unit is None or unit.offset != offset:
+                unit = Unit(first, end, text)
+                self.parse(unit)
+            else:
+                unit.start, unit.end = first, end
+            units.append(unit)
+        return units
+
+    def parse(self, unit):
+        try:
+            if self.bank:
+                self.parse_questions(unit)
+            else:
+                self.parse_section(unit)
+        except Exception as e:
+            # a bug in examtex should not take the server down with it
+            unit.errors = [examtex.ExamError(
+                "examtex failed on this part: {!r}".format(e))]
+
+    def parse_section(self, unit):
+        lines = self.lines[unit.start:unit.end]
+        if not examtex.Exam.header_ptrn.match(lines[0]):
+            # the lines before the first section, which are ignored
+            return
+        try:
+            exam = examtex.Exam(lines, lazy=True, basedir=self.basedir,
+                                template="", errors=unit.errors)
+        except examtex.ExamError as e:
+            unit.errors.append(e)
+            return
+        exam.source.positions = unit.positions
+        sheet = exam.meta["image sheet"]
+        if sheet and examtex.find_image(
+                os.path.join(self.basedir, sheet)) is None:
+            unit.errors.append(examtex.ExamError(
+                "Image not found: " + sheet, lineno=exam.meta_lineno))
+        unit.span = bool(exam.spans)
+        if unit.span:
+            try:
+                section = exam.section(0)
+            except examtex.ExamError as e:
+                unit.errors.append(e)
+                return
+            unit.errors += examtex.check_content(section.content,
+                                                 self.basedir)
+            unit.section = section
+            unit.count = section.count()
+            if section.pool:
+                unit.count += section.pool.count
+        unit.errors = examtex.sorted_errors(unit.errors)
+
+    def parse_questions(self, unit):
+        lines = self.lines[unit.start:unit.end]
+        if unit.start > self.header:
+            unit.offset = 1
+            header = self.lines[self.header]
+            if not re.match(r"(?i)\s*\[(match|tf|mc|frq)\]\s*$", header):
+                # reported once, by the unit of the header
+                return
+            lines = [header] + lines
+        unit.errors = examtex.check_bank(
+            self.path, [line.encode() for line in lines], unit.positions)
+
+    def change(self, change):
+        """Applies a content change of a didChange notification."""
+        lines = self.lines
+        if "range" not in change:
+            self.lines = change["text"].splitlines(True)
+            self.rescan()
+            return
+        start, end = change["range"]["start"], change["range"]["end"]
+        a, b = start["line"], end["line"]
+        head = lines[a] if a < len(lines) else ""
+        tail = lines[b] if b < len(lines) else ""
+        text = (head[:column(head, start["character"])] + change["text"] +
+                tail[column(tail, end["character"]):])
+        new = text.splitlines(True)
+        stop = min(b + 1, len(lines))
+        lines[a:stop] = new
+        delta = len(new) - (stop - a)
+        units = self.units
+        if not units or (self.bank and a <= self.header):
+            # the header of a bank decides how its questions parse
+            self.rescan()
+            return
+        # the units around the change too, since it can join or split
+        # them (e.g. by removing a header)
+        starts = [unit.start for unit in units]
+        i = max(bisect.bisect_right(starts, a) - 2, 0)
+        j = min(bisect.bisect_right(starts, max(a, stop - 1)) + 1,
+                len(units))
+        old = {unit.text: unit for unit in units[i:j]}
+        region = self.scan(units[i].start, units[j - 1].end + delta, old)
+        for unit in units[j:]:
+            unit.start += delta
+            unit.end += delta
+        units[i:j] = region
+
+    def reparse_pools(self):
+        """Parses the sections drawing from question banks again, since
+        the banks may have changed."""
+        for unit in self.units:
+            if not self.bank and pool_ptrn.search(unit.text):
+                fresh = Unit(unit.start, unit.end, unit.text)
+                self.parse(fresh)
+                self.units[self.units.index(unit)] = fresh
+
+    def diagnostics(self):
+        found = []
+        if not self.bank and not any(
+                examtex.Exam.header_ptrn.match(self.lines[unit.start])
+                for unit in self.units):
+            found.append((0, "No sections found."))
+        for unit in self.units:
+            for e in unit.errors:
+                found.append((unit.line(e.lineno), e.message))
+        last = max(len(self.lines) - 1, 0)
+        diagnostics = []
+        for line, message in found:
+            line = min(max(line, 0), last)
+            text = self.lines[line].rstrip("\r\n") if self.lines else ""
+            diagnostics.append({
+                "range": {"start": {"line": line,
+                                    "character": len(text) -
+                                    len(text.lstrip())},
+                          "end": {"line": line,
+                                  "character": len(text.encode(
+                                      "utf-16-le")) // 2}},
+                "severity": SEVERITY_ERROR, "source": "examtex",
+                "message": message})
+        return diagnostics
+
+    def items(self, unit):
+        """Returns (depth, first line, last line, item) for each item parsed
+        in unit, in order of line."""
+        positions = sorted(unit.positions, key=lambda p: p[1])
+        found = []
+        for k, (depth, lineno, item) in enumerate(positions):
+            last = unit.end - 1
+            for d, next_lineno, _ in positions[k + 1:]:
+                if d <= depth:
+                    last = unit.line(next_lineno) - 1
+                    break
+            first = unit.line(lineno)
+            while last > first and self.lines[last].strip() == "":
+                last -= 1
+            found.append((depth, first, last, item))
+        return found
+
+    def is_question(self, unit, depth, item):
+        if depth > 0:
+            return type(item) == examtex.FRQ.FRQuestion
+        if self.bank:
+            return True
+        return unit.section is not None and unit.section.is_question(item)
+
+    def symbols(self):
+        """Returns the outline: the sections and their numbered questions,
+        or the questions of a bank. The outline of each unit is kept until
+        it moves or its questions are numbered differently."""
+        symbols = []
+        number = 0
+        for unit in self.units:
+            if unit.outline is None or unit.outline[0] != (unit.start,
+                                                           number):
+                unit.outline = ((unit.start, number),
+                                self.unit_symbols(unit, number))
+            found, number = unit.outline[1]
+            symbols += found
+        return symbols
+
+    def unit_symbols(self, unit, number):
+        """Returns the symbols of unit, whose questions are numbered after
+        number, and the number of the last question in it."""
+        questions = []
+        parents = {}
+        for depth, first, last, item in self.items(unit):
+            if not self.is_question(unit, depth, item):
+                continue
+            name = label(item)
+            if depth == 0:
+                number += 1
+                name = "{}. {}".format(number, name)
+            symbol = {"name": name, "kind": SYMBOL_FIELD,
+                      "range": line_range(first, last, self.lines),
+                      "selectionRange": line_range(first, first, self.lines),
+                      "children": []}
+            parents[depth] = symbol
+            if depth == 0:
+                questions.append(symbol)
+            elif depth - 1 in parents:
+                parents[depth - 1]["children"].append(symbol)
+        if self.bank:
+            return questions, number
+        # the questions drawn from banks
+        number += max(unit.count - len(questions), 0)
+        header = self.lines[unit.start].strip()
+        if not examtex.Exam.header_ptrn.match(header):
+            return [], number
+        name = header.upper()
+        if unit.section is not None and unit.section.options["name"]:
+            name += " " + unit.section.options["name"]
+        last = unit.end - 1
+        while last > unit.start and self.lines[last].strip() == "":
+            last -= 1
+        symbol = {"name": name, "kind": SYMBOL_NAMESPACE,
+                  "range": line_range(unit.start, last, self.lines),
+                  "selectionRange": line_range(unit.start, unit.start,
+                                               self.lines),
+                  "children": questions}
+        if unit.count:
+            symbol["detail"] = "{} question{}".format(
+                unit.count, "" if unit.count == 1 else "s")
+        return [symbol], number
+
+    def unit_at(self, line):
+        starts = [unit.start for unit in self.units]
+        return self.units[max(bisect.bisect_right(starts, line) - 1, 0)]
+
+    def hover(self, line):
+        """Returns the markdown describing the answer to the question on
+        line, or None."""
+        if not self.units:
+            return None
+        unit = self.unit_at(line)
+        found = [(depth, item) for depth, first, last, item
+                 in self.items(unit) if first <= line <= last
+                 and self.is_question(unit, depth, item)]
+        if not found:
+            return None
+        depth, item = found[-1]
+        if type(item) == examtex.FRQ.FRQuestion:
+            text = []
+            if item.answer is not None:
+                text.append("**Answer:** " + item.answer)
+            points = item.total_points()
+            if points is not None:
+                text.append("{:g} point{}".format(
+                    points, "" if points == 1 else "s"))
+            return "\n\n".join(text) or None
+        if self.bank:
+            if type(item) == tuple:
+                return "**Answer:** " + item[1]
+            if item.randomize:
+                return ("**Answer:** {}\n\nThe choices are shuffled when "
+                        "drawn.".format(item.correct_choice))
+            return "**Answer {}:** {}".format(
+                chr(65 + item.given.index(item.correct_choice)),
+                item.correct_choice)
+        self.shuffle(unit)
+        if type(item) == tuple:
+            letter = unit.section.answer(item[1])
+            if not unit.section.wordbank:
+                return "**Answer: {}**".format(letter)
+            return "**Answer {}:** {}".format(letter, item[1])
+        text = "**Answer {}:** {}".format(item.get_answer(),
+                                          item.correct_choice)
+        if item.randomize:
+            text += "\n\nWith the exam's default seed."
+        return text
+
+    def shuffle(self, unit):
+        """Shuffles the section of unit as examtex shuffles it with the
+        default seed, so that its answer letters are those of the exam."""
+        index = sum(1 for u in self.units[:self.units.index(unit)]
+                    if u.span)
+        if unit.shuffled != (self.seed, index):
+            rng = random.Random("{}-{}".format(self.seed, index))
+            unit.section.shuffle(rng)
+            unit.shuffled = (self.seed, index)
+
+
+def label(item, width=60):
+    """Returns the text of a question, shortened to width."""
+    text = item[0] if type(item) == tuple else item.question
+    text = " ".join(text.split())
+    return text if len(text) <= width else text[:width - 3] + "..."
+
+
+def line_range(first, last, lines):
+    end = len(lines[last].rstrip("\r\n")) if last < len(lines) else 0
+    return {"start": {"line": first, "character": 0},
+            "end": {"line": last, "character": end}}
+
+
+def read_message(stream):
+    """Reads one message from stream (binary), or returns None at its
+    end."""
+    length = None
+    while True:
+        line = stream.readline()
+        if not line:
+            return None
+        line = line.strip()
+        if not line:
+            break
+        name, _, value = line.decode("ascii").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    if length is None:
+        return None
+    return json.loads(stream.read(length).decode("utf-8"))
+
+
+def write_message(stream, message):
+    body = json.dumps(message, separators=(",", ":")).encode("utf-8")
+    stream.write("Content-Length: {}\r\n\r\n".format(len(body))
+                 .encode("ascii") + body)
+    stream.flush()
+
+
+class Server:
+
+    def __init__(self, stdin, stdout):
+        self.stdin = stdin
+        self.stdout = stdout
+        self.documents = {}
+        self.shutdown = False
+
+    def run(self):
+        """Handles messages until exit. Returns the exit status."""
+        while True:
+            message = read_message(self.stdin)
+            if message is None:
+                return 1
+            method = message.get("method")
+            if method == "exit":
+                return 0 if self.shutdown else 1
+            handler = getattr(self, "on_" + (method or "").replace(
+                "/", "_").replace("$", "_"), None)
+            if "id" not in message:
+                if handler is None:
+                    continue
+                try:
+                    handler(message.get("params"))
+                except Exception:
+                    # notifications get no response, so the editor's log
+                    # of the server's stderr is the place for this
+                    import traceback
+                    traceback.print_exc()
+                continue
+            if handler is None:
+                self.respond(message["id"], error={
+                    "code": METHOD_NOT_FOUND,
+                    "message": "Unknown method: {}".format(method)})
+                continue
+            try:
+                result = handler(message.get("params"))
+            except Exception as e:
+                self.respond(message["id"], error={
+                    "code": INTERNAL_ERROR, "message": repr(e)})
+                continue
+            self.respond(message["id"], result)
+
+    def respond(self, id, result=None, error=None):
+        message = {"jsonrpc": "2.0", "id": id}
+        if error is None:
+            message["result"] = result
+        else:
+            message["error"] = error
+        write_message(self.stdout, message)
+
+    def notify(self, method, params):
+        write_message(self.stdout, {"jsonrpc": "2.0", "method": method,
+                                    "params": params})
+
+    def publish(self, document):
+        self.notify("textDocument/publishDiagnostics",
+                    {"uri": document.uri,
+                     "diagnostics": document.diagnostics()})
+
+    def on_initialize(self, params):
+        return {"capabilities": {
+                    "textDocumentSync": {"openClose": True,
+                                         "change": SYNC_INCREMENTAL,
+                                         "save": True},
+                    "hoverProvider": True,
+                    "documentSymbolProvider": True},
+                "serverInfo": {"name": "examlsp"}}
+
+    def on_shutdown(self, params):
+        self.shutdown = True
+        return None
+
+    def on_textDocument_didOpen(self, params):
+        item = params["textDocument"]
+        document = Document(item["uri"], item["text"])
+        self.documents[item["uri"]] = document
+        self.publish(document)
+
+    def on_textDocument_didChange(self, params):
+        document = self.documents[params["textDocument"]["uri"]]
+        for change in params["contentChanges"]:
+            document.change(change)
+        self.publish(document)
+
+    def on_textDocument_didSave(self, params):
+        if not uri_path(params["textDocument"]["uri"]).endswith(".bank"):
+            return
+        for document in self.documents.values():
+            document.reparse_pools()
+            self.publish(document)
+
+    def on_textDocument_didClose(self, params):
+        uri = params["textDocument"]["uri"]
+        self.documents.pop(uri, None)
+        self.notify("textDocument/publishDiagnostics",
+                    {"uri": uri, "diagnostics": []})
+
+    def on_textDocument_documentSymbol(self, params):
+        return self.documents[params["textDocument"]["uri"]].symbols()
+
+    def on_textDocument_hover(self, params):
+        document = self.documents[params["textDocument"]["uri"]]
+        text = document.hover(params["position"]["line"])
+        if text is None:
+            return None
+        return {"contents": {"kind": "markdown", "value": text}}
+
+
+def main():
+    sys.exit(Server(sys.stdin.buffer, sys.stdout.buffer).run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+"""A local service that renders exams, for web forms and LMS integrations
+on the same host.
+
+    python3 examserve.py serve [--port PORT] [--workers N] [--queue N]
+        [--timeout SECONDS]
+    python3 examserve.py render FILE [--url URL] [-s SEED] [--versions N]
+        [--answer-sheet] [--pdf | --html] [-o DIR]
+    python3 examserve.py stats [--url URL]
+
+The server keeps the transpiler and template.tex loaded, and compiles
+pdfs on a bounded pool of latexmk workers. POST /render takes a JSON
+object:
+
+    {"source": "<.exam file contents>", "name": "exam", "seed": "1",
+     "versions": 1, "shuffle_questions": false, "answer_sheet": null,
+     "pdf": false, "html": false}
+
+and answers with {"files": {filename: contents}}, where pdfs are base64
+encoded. With "html", the documents are HTML pages rendered without
+LaTeX. Paths of images and question banks in the source must be
+absolute, since the exam is built in a temporary directory. Without a
+"seed", one is derived from "name", which is not the seed examtex uses
+for a file of that name; the render command sends the file's. GET /stats
+reports the queue depth and the latency of each stage.
+"""
+import base64
+import collections
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import examtex  # noqa: E402
+
+
+class RequestError(Exception):
+
+    def __init__(self, status, message, log=None):
+        Exception.__init__(self, message)
+        self.status = status
+        self.log = log
+
+
+class Stats:
+    """Counts of jobs and the latencies of the last `keep` jobs of each
+    stage."""
+
+    def __init__(self, keep=1000):
+        self.lock = threading.Lock()
+        self.keep = keep
+        self.counts = collections.Counter()
+        self.latencies = {}
+        self.queued = 0
+        self.running = 0
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def record(self, stage, secs):
+        with self.lock:
+            if stage not in self.latencies:
+                self.latencies[stage] = collections.deque(maxlen=self.keep)
+            self.latencies[stage].append(secs)
+
+    def to_dict(self):
+        with self.lock:
+            latency = {}
+            for stage, samples in self.latencies.items():
+                ordered = sorted(samples)
+                latency[stage] = {
+                    "count": len(ordered),
+                    "mean": sum(ordered) / len(ordered),
+                    "p50": ordered[len(ordered) // 2],
+                    "p95": ordered[min(len(ordered) - 1,
+                                       int(len(ordered) * 0.95))],
+                    "max": ordered[-1]}
+            return {"queue_depth": self.queued, "running": self.running,
+                    "counts": dict(self.counts), "latency": latency}
+
+
+class Renderer:
+    """Renders exams for the server. Exams are transpiled on the request
+    threads; latexmk jobs run on a pool of `workers` threads, with at most
+    `queue` jobs waiting and each one killed after `timeout` seconds."""
+
+    def __init__(self, workers=None, queue=64, timeout=120):
+        self.workers = workers or os.cpu_count() or 1
+        self.queue = queue
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        self.stats = Stats()
+        examtex.load_template()
+
+    def transpile(self, path, seed, versions, shuffle_questions,
+                  html=False):
+        """Transpiles the exam at path. Returns the tex files (or HTML
+        pages) written."""
+        start = time.perf_counter()
+        try:
+            return examtex.transpile(path, seed, versions, shuffle_questions,
+                                     use_cache=False, html=html).written
+        except examtex.ExamError as e:
+            out = io.StringIO()
+            examtex.report_error(e, out)
+            raise RequestError(400, out.getvalue().strip())
+        finally:
+            self.stats.record("transpile", time.perf_counter() - start)
+
+    def compile(self, tex_file):
+        with self.stats.lock:
+            self.stats.queued -= 1
+            self.stats.running += 1
+        try:
+            return examtex.compile_tex(tex_file, ".examtex-build",
+                                       timeout=self.timeout)
+        finally:
+            with self.stats.lock:
+                self.stats.running -= 1
+
+    def build(self, tex_files):
+        """Compiles tex_files on the pool. Returns {pdf name: base64
+        contents}."""
+        with self.stats.lock:
+            if self.stats.queued + len(tex_files) > self.queue:
+                self.stats.counts["rejected"] += 1
+                raise RequestError(503, "Queue is full.")
+            self.stats.queued += len(tex_files)
+        jobs = [(f, self.pool.submit(self.compile, f)) for f in tex_files]
+        files = {}
+        failed = []
+        status = 422
+        for tex_file, job in jobs:
+            code, secs, log = job.result()
+            self.stats.record("latexmk", secs)
+            if code == 124:
+                self.stats.count("timeouts")
+                status = 504
+            elif code != 0:
+                self.stats.count("failed")
+            if code != 0:
+                failed.append(log)
+                continue
+            with open(tex_file[:-4] + ".pdf", 'rb') as filein:
+                files[os.path.basename(tex_file[:-4]) + ".pdf"] = \
+                    base64.b64encode(filein.read()).decode()
+        if failed:
+            raise RequestError(status, "LaTeX failed.", "\n".join(failed))
+        return files
+
+    def render(self, request):
+        """Renders the exam described by a /render request. Returns the
+        response."""
+        source = request.get("source")
+        if not isinstance(source, str):
+            raise RequestError(400, "Missing exam source.")
+        name = os.path.basename(str(request.get("name") or "exam"))
+        versions = request.get("versions", 1)
+        # bool is a subclass of int, but true is no number of versions
+        if not isinstance(versions, int) or isinstance(versions, bool):
+            raise RequestError(400, "Versions must be an integer.")
+        seed = request.get("seed")
+        if seed is None:
+            # derived from the name rather than the temporary path, so
+            # that requests for the same exam shuffle alike; the command
+            # line derives its default from the file's absolute path, so
+            # matching its output takes an explicit seed
+            seed = sum(map(ord, name))
+        seed = str(seed)
+        html = bool(request.get("html"))
+        if html and request.get("pdf"):
+            raise RequestError(400, "HTML pages are not compiled to pdfs.")
+        if request.get("answer_sheet") is not None:
+            # a later meta section overrides the source's
+            source += "\n[Meta]\nAnswer sheet:: {}\n".format(
+                bool(request["answer_sheet"]))
+        start = time.perf_counter()
+        workdir = tempfile.mkdtemp(prefix="examserve-")
+        try:
+            path = os.path.join(workdir, name + ".exam")
+            with open(path, 'w') as fileout:
+                fileout.write(source)
+            written = self.transpile(path, seed, versions,
+                                     bool(request.get("shuffle_questions")),
+                                     html)
+            if request.get("pdf"):
+                files = self.build(written)
+            else:
+                files = {}
+                for tex_file in written:
+                    with open(tex_file, 'r') as filein:
+                        files[os.path.basename(tex_file)] = filein.read()
+            csv = os.path.join(workdir, name + "-VERSIONS.csv")
+            if os.path.isfile(csv):
+                with open(csv, 'r') as filein:
+                    files[os.path.basename(csv)] = filein.read()
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        self.stats.record("request", time.perf_counter() - start)
+        self.stats.count("completed")
+        return {"files": files}
+
+
+class Handler(BaseHTTPRequestHandler):
+    renderer = None
+
+    def respond(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.respond(200, self.renderer.stats.to_dict())
+        elif self.path == "/health":
+            self.respond(200, {"ok": True})
+        else:
+            self.respond(404, {"error": "Not found."})
+
+    def do_POST(self):
+        if self.path != "/render":
+            self.respond(404, {"error": "Not found."})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                request = json.loads(self.rfile.read(length).decode())
+            except ValueError:
+                raise RequestError(400, "Request must be a JSON object.")
+            if not isinstance(request, dict):
+                raise RequestError(400, "Request must be a JSON object.")
+            self.respond(200, self.renderer.render(request))
+        except RequestError as e:
+            if e.status == 400:
+                self.renderer.stats.count("invalid")
+            body = {"error": str(e)}
+            if e.log:
+                body["log"] = e.log
+            self.respond(e.status, body)
+        except Exception as e:
+            # still answer the client rather than drop the connection
+            self.renderer.stats.count("errors")
+            traceback.print_exc()
+            self.respond(500, {"error": "{}: {}".format(type(e).__name__,
+                                                        e)})
+
+    def log_message(self, format, *args):
+        sys.stderr.write("{} {}\n".format(time.strftime("%H:%M:%S"),
+                                          format % args))
+
+
+def serve(host="127.0.0.1", port=8765, workers=None, queue=64,
+          timeout=120):
+    Handler.renderer = Renderer(workers, queue, timeout)
+    server = ThreadingHTTPServer((host, port), Handler)
+    print("Serving on http://{}:{}/ with {} workers.".format(
+        host, server.server_address[1], Handler.renderer.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+def request(url, path, body=None):
+    """Sends a request to the server at url. Returns (status, response)."""
+    import urllib.error
+    import urllib.request
+    data = None if body is None else json.dumps(body).encode()
+    req = urllib.request.Request(url.rstrip("/") + path, data=data,
+                                 headers={"Content-Type":
+                                          "application/json"})
+    try:
+        with urllib.request.urlopen(req) as response:
+            return response.status, json.load(response)
+    except urllib.error.HTTPError as e:
+        return e.code, json.load(e)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="examtex render service")
+    commands = parser.add_subparsers(dest="command", required=True)
+    server = commands.add_parser("serve")
+    server.add_argument("--host", default="127.0.0.1")
+    server.add_argument("--port", type=int, default=8765)
+    server.add_argument("--workers", type=int)
+    server.add_argument("--queue", type=int, default=64)
+    server.add_argument("--timeout", type=float, default=120)
+    client = commands.add_parser("render")
+    client.add_argument("filename")
+    client.add_argument("-s", "--seed")
+    client.add_argument("--versions", type=int, default=1)
+    client.add_argument("--shuffle-questions", action="store_true")
+    client.add_argument("--answer-sheet", action="store_true", default=None)
+    output = client.add_mutually_exclusive_group()
+    output.add_argument("--pdf", action="store_true")
+    output.add_argument("--html", action="store_true")
+    client.add_argument("-o", "--outdir", default=".")
+    stats = commands.add_parser("stats")
+    for sub in [client, stats]:
+        sub.add_argument("--url", default="http://127.0.0.1:8765")
+    args = parser.parse_args(argv)
+
+    if args.command == "serve":
+        serve(args.host, args.port, args.workers, args.queue, args.timeout)
+    elif args.command == "stats":
+        status, body = request(args.url, "/stats")
+        print(json.dumps(body, indent=2))
+    else:
+        with open(args.filename, 'r') as filein:
+            source = filein.read()
+        name = os.path.basename(args.filename)
+        if name.endswith(".exam"):
+            name = name[:-5]
+        seed = args.seed
+        if seed is None:
+            # the file's, as examtex would shuffle it
+            seed = examtex.default_seed(os.path.abspath(args.filename))
+        status, body = request(args.url, "/render", {
+            "source": source, "name": name, "seed": seed,
+            "versions": args.versions,
+            "shuffle_questions": args.shuffle_questions,
+            "answer_sheet": args.answer_sheet, "pdf": args.pdf,
+            "html": args.html})
+        if status != 200:
+            print(body.get("log", ""))
+            print("Error {}: {}".format(status, body["error"]))
+            sys.exit(1)
+        for filename, contents in body["files"].items():
+            mode = 'w'
+            if filename.endswith(".pdf"):
+                contents = base64.b64decode(contents)
+                mode = 'wb'
+            with open(os.path.join(args.outdir, filename), mode) as fileout:
+                fileout.write(contents)
+            print(filename)
+
+
+if __name__ == "__main__":
+    main()
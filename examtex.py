@@ -1,125 +1,879 @@
-import numpy as np
+import functools
+import hashlib
+import io
+import json
+import math
 import re
 import sys
 import os
 import random
+import threading
+import time
+
+
+class ExamError(Exception):
+    """An error in an .exam file: its message, the offending text (or
+    None) and its line number (or None)."""
+
+    def __init__(self, message, context=None, lineno=None):
+        Exception.__init__(self, message, context, lineno)
+        self.message = message
+        self.context = context
+        self.lineno = lineno
+
+    def __str__(self):
+        if self.lineno is not None:
+            return "Line {}: {}".format(self.lineno, self.message)
+        return self.message
+
+
+def compile_error(err, traceback=None, lineno=None):
+    raise ExamError(err, traceback, lineno)
+
+
+def report_error(e, file=None):
+    """Prints an ExamError the way the command line reports it."""
+    file = file or sys.stderr
+    print(e, file=file)
+    if e.context:
+        print("\t", e.context, file=file)
+
+
+double_quote_ptrn = re.compile("\"([^\"]*)\"")
+italic_ptrn = re.compile(r"\\i\s*{")
+bold_ptrn = re.compile(r"\\b\s*{")
+markup_ptrn = re.compile(r"\\([bi])\s*{")
+brace_ptrn = re.compile(r"\\.|[{}]")
+brace_depths = {"{": 1, "}": -1}
+katex_url = "https://cdn.jsdelivr.net/npm/katex@0.16.9/dist/"
+katex_script = """
+document.addEventListener("DOMContentLoaded", function () {
+  renderMathInElement(document.body, {
+    delimiters: [{left: "$$", right: "$$", display: true},
+                 {left: "\\\\[", right: "\\\\]", display: true},
+                 {left: "$", right: "$", display: false},
+                 {left: "\\\\(", right: "\\\\)", display: false}],
+    throwOnError: false});
+});
+"""
+html_style = """
+body { max-width: 7in; margin: 0 auto; padding: 0.5in;
+       font: 12pt/1.4 "Latin Modern Roman", Georgia, serif; }
+header { display: flex; justify-content: space-between;
+         border-bottom: 1px solid; margin-bottom: 2em; }
+section { margin-bottom: 3em; }
+.cover { text-align: center; }
+.cover h1 { margin-top: 2in; }
+.cover .subtitle { font-size: 1.5em; }
+.cover table { margin: 2em auto; text-align: left; }
+.cover th { font-weight: normal; padding-right: 1em; }
+.line { display: inline-block; width: 0.5in; border-bottom: 1px solid; }
+.cover td.line { display: table-cell; width: 3in; }
+ol.questions > li { margin-bottom: 1.5em; }
+ol.choices, ol.wordbank { list-style-type: upper-alpha; }
+ol.parts { list-style-type: lower-alpha; }
+ol.parts ol.parts { list-style-type: lower-roman; }
+ol.parts ol.parts ol.parts { list-style-type: lower-greek; }
+ol.parts > li { margin-top: 1em; }
+li.module { list-style: none; }
+.twocolumn { columns: 2; }
+.twocolumn h2 { column-span: all; }
+ol.questions > li, .image { break-inside: avoid; }
+ol.wordbank { columns: 3; border: 1px solid; padding: 0.5em 2.5em; }
+ol.blanks { columns: 5; }
+.blank { display: inline-block; min-width: 2em; margin-right: 0.5em;
+         border-bottom: 1px solid; text-align: center; }
+.points { margin-right: 0.5em; }
+.solution { margin: 0.5em 0; padding: 0.5em; border: 1px solid; }
+.answer, .correct { color: #d0178a; font-weight: bold; }
+.image { text-align: center; margin: 1em 0; }
+.image img, .image object { max-width: 100%; }
+.latex { white-space: pre-wrap; margin: 1em 0; }
+.newcol { break-after: column; }
+@media print {
+  body { padding: 0; }
+  section:not(.cover), .newpage { break-before: page; }
+}
+"""
+
+
+def open_single_quotes(line):
+    """Replace the opening quote of each single quoted substring with `.
+    An opening quote follows whitespace, and the next quote after it that
+    is left as is must be followed by whitespace. Whether a quote opens
+    depends only on the quotes to its right, so they are decided in one
+    right-to-left pass."""
+    chars = list(line)
+    close = -1
+    i = line.rfind("'")
+    while i != -1:
+        if (i > 0 and line[i-1].isspace() and close > i + 1
+                and close + 1 < len(line) and line[close+1].isspace()):
+            chars[i] = "`"
+        else:
+            close = i
+        i = line.rfind("'", 0, i)
+    return "".join(chars)
 
 
-def compile_error(err, traceback=None):
-    """Does this really need a docstring."""
-    print(err, file=sys.stderr)
-    if traceback:
-        print("\t", traceback)
-    sys.exit(1)
-
-
+@functools.lru_cache(maxsize=8192)
 def latexify(line):
     """Replace LaTeX-sensitive characters with LaTeX counterparts.
-    Returns modified line."""
+    Returns modified line. Results are cached, since the same strings
+    (e.g. TF choices) recur throughout an exam."""
     line = line.replace("%", "\\%")
-    # search for double quoted substrings, replace with ``''
-    match = re.search("\"[^\"]*\"", line)
-    while match:
-        repl = "``{}''".format(match.group(0)[1:-1])
-        line = line[:match.start()] + repl + line[match.end():]
-        match = re.search("\"[^\"]*\"", line)
-    # search for single quoted substrings, replace with `'. Capture
-    # surrounding whitespace
-    match = re.search("\\s'[^']+'\\s", line)
-    while match:
-        repl = "`{}'".format(match.group(0)[2:-2])
-        line = line[:match.start()+1] + repl + line[match.end()-1:]
-        match = re.search("\\s'[^']+'\\s", line)
+    # double quoted substrings become ``''
+    line = double_quote_ptrn.sub(r"``\1''", line)
+    # single quoted substrings become `'
+    if "'" in line:
+        line = open_single_quotes(line)
     # custom bold and italics syntax
-    line = re.sub(r"\\i\s*{", r"\\textit{", line)
-    line = re.sub(r"\\b\s*{", r"\\textbf{", line)
+    line = italic_ptrn.sub(r"\\textit{", line)
+    line = bold_ptrn.sub(r"\\textbf{", line)
+    return line
+
+
+@functools.lru_cache(maxsize=8192)
+def htmlify(line):
+    """Returns line as HTML, the counterpart of latexify: special
+    characters escaped, double quoted substrings curled, and the custom
+    bold and italics syntax marked up. Math between dollar signs is left
+    as it is, for KaTeX to render in the browser."""
+    line = line.replace("&", "&amp;").replace("<", "&lt;")
+    line = line.replace(">", "&gt;").replace('\\%', '%')
+    if '"' in line:
+        line = double_quote_ptrn.sub(curl_quotes, line)
+    if "\\" not in line:
+        return line
+    match = markup_ptrn.search(line)
+    while match:
+        # the brace closing the one the match ends with
+        depth = 1
+        for brace in brace_ptrn.finditer(line, match.end()):
+            depth += brace_depths.get(brace.group(), 0)
+            if depth == 0:
+                end = brace.end()
+                break
+        else:
+            break
+        tag = "strong" if match.group(1) == "b" else "em"
+        line = "{}<{}>{}</{}>{}".format(line[:match.start()], tag,
+                                        line[match.end():end - 1], tag,
+                                        line[end:])
+        match = markup_ptrn.search(line, match.start())
     return line
 
 
-def process_options(content):
+def curl_quotes(match):
+    return "\u201c" + match.group(1) + "\u201d"
+
+
+def html_attr(value):
+    return value.replace("&", "&amp;").replace('"', "&quot;")
+
+
+class Source:
+    """The nonblank lines of an .exam file and their line numbers. Paths
+    in the file are relative to basedir. first is the line number of the
+    first line, for sources read from the middle of a file."""
+
+    def __init__(self, lines, basedir="", first=1, errors=None):
+        self.basedir = basedir
+        self.lines = []
+        self.linenos = []
+        # the positions of the lines that follow blank lines
+        self.gaps = []
+        blank = False
+        for lineno, line in enumerate(lines, first):
+            if line.strip() != "":
+                if blank:
+                    self.gaps.append(len(self.lines))
+                    blank = False
+                self.lines.append(line)
+                self.linenos.append(lineno)
+            else:
+                blank = True
+        self.expanded = [line.replace("\t", "    ") for line in self.lines]
+        # a list collecting ExamErrors while checking (see check_exam), in
+        # which case parsing goes on past them where it can
+        self.errors = errors
+        # a list collecting (depth, line number, item) for every item
+        # gobble_all reads, if set (see examlsp)
+        self.positions = None
+
+    def report(self, e):
+        """Raises the ExamError e, or collects it while checking."""
+        if self.errors is None:
+            raise e
+        self.errors.append(e)
+
+
+class Cursor:
+    """Walks the lines [pos, end) of a Source without copying them. At
+    depth d (inside d levels of FRQ nesting) lines are seen with tabs
+    expanded and their first 4*d spaces removed."""
+
+    def __init__(self, source, pos, end, depth=0):
+        self.source = source
+        self.pos = pos
+        self.end = end
+        self.depth = depth
+
+    def __bool__(self):
+        return self.pos < self.end
+
+    def __len__(self):
+        return self.end - self.pos
+
+    def line(self, i):
+        if self.depth == 0:
+            return self.source.lines[i]
+        line = self.source.expanded[i]
+        indent = 4 * self.depth
+        if line[:indent] != " " * indent:
+            compile_error("Bad indent.", self.source.lines[i],
+                          self.source.linenos[i])
+        return line[indent:]
+
+    def lines(self):
+        return [self.line(i) for i in range(self.pos, self.end)]
+
+    def lineno(self):
+        return self.source.linenos[min(self.pos, self.end - 1)]
+
+    def peek(self):
+        return self.line(self.pos)
+
+    def take(self):
+        line = self.line(self.pos)
+        self.pos += 1
+        return line
+
+    def find(self, pattern):
+        """Returns the index of the first remaining line matching pattern,
+        or None."""
+        for i in range(self.pos, self.end):
+            if re.match(pattern, self.line(i)):
+                return i
+        return None
+
+    def upto(self, end):
+        """Returns a cursor over the lines before index end and advances
+        this one past them."""
+        cur = Cursor(self.source, self.pos, end, self.depth)
+        self.pos = end
+        return cur
+
+    def take_block(self):
+        """Consumes the current line and the indented lines after it.
+        Returns the current line and a cursor over the indented lines."""
+        head = self.take()
+        end = self.pos
+        while end < self.end and re.match(r"\s", self.line(end)):
+            end += 1
+        return head, self.upto(end)
+
+    def deeper(self):
+        """Returns a cursor over the same lines one indent level deeper,
+        checking that they are all indented."""
+        cur = Cursor(self.source, self.pos, self.end, self.depth + 1)
+        for i in range(cur.pos, cur.end):
+            cur.line(i)
+        return cur
+
+
+def process_options(cur):
     options = {}
-    for line in content:
+    while cur:
+        lineno = cur.lineno()
+        line = cur.take()
         try:
             key, val = line.split("::")
         except ValueError:
-            compile_error("Options must have 'key:: value' structure.", line)
+            cur.source.report(ExamError(
+                "Options must have 'key:: value' structure.", line, lineno))
+            continue
         key = key.strip().lower()
         val = [x.strip() for x in val.strip().split(";;")]
         options[key] = val
     return options
 
 
-class Section:
+def gobble_all(cur, gobble):
+    """Returns what gobble takes from cur until it is empty. While
+    checking, an item with an error is reported and skipped along with
+    the lines indented under it, and the items after it are still read."""
+    content = []
+    while cur:
+        pos = cur.pos
+        try:
+            content.append(gobble(cur))
+        except ExamError as e:
+            cur.source.report(e)
+            cur.pos = max(cur.pos, pos + 1)
+            indent = 4 * cur.depth
+            while cur and re.match(r"\s",
+                                   cur.source.expanded[cur.pos][indent:]):
+                cur.pos += 1
+            continue
+        if cur.source.positions is not None:
+            cur.source.positions.append(
+                (cur.depth, cur.source.linenos[pos], content[-1]))
+    return content
+
+
+class Bank:
+    """A file of questions for pool sections to draw from. It starts with a
+    section header naming the type of its questions, followed by questions
+    in that section's syntax, each optionally preceded by "@Key:: value"
+    lines setting its tags, difficulty and points. Where each question
+    starts is indexed once and the index is saved next to the bank, so
+    that drawing only reads and parses the questions drawn. Questions
+    once parsed are saved next to it as well (see save_ast), and loaded
+    instead of parsed again while the bank is unchanged."""
+
+    # bump whenever the index format changes
+    version = 1
+    filters = ["tags", "difficulty", "points"]
+
+    def __init__(self, path, errors=None, lines=None, save=True):
+        """Indexes the bank at path. If errors is a list, the problems
+        found are collected in it instead of raised (see check_bank), and
+        the index is built anew and not saved. If lines is given, the
+        bank is indexed from them (as bytes) instead of the file, and only
+        for checking. A new index is only saved if save is set."""
+        self.path = path
+        self.signature = Bank.stat(path) if lines is None else None
+        self.index_path = os.path.join(os.path.dirname(path),
+                                       "." + os.path.basename(path) +
+                                       ".index")
+        self.ast_path = os.path.join(os.path.dirname(path),
+                                     "." + os.path.basename(path) + ".ast")
+        # parsed questions by position in the index
+        self.parsed = {}
+        # held while questions are loaded, since builds share banks
+        self.lock = threading.Lock()
+        # the questions saved parsed, once read: their positions, and where
+        # each one's marshalled data is in ast_blob
+        self.ast_ids = None
+        self.ast_slots = None
+        self.ast_offsets = None
+        self.ast_blob = None
+        # whether the index was built but not saved yet (see load_bank)
+        self.unsaved = False
+        if errors is not None or lines is not None:
+            self.build_index(errors, lines)
+        elif not self.load_index():
+            self.build_index()
+            if save:
+                self.save_index()
+            else:
+                self.unsaved = True
+
+    def stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        # e.g. an empty path in a Pool option names the exam's directory
+        if stat is None or not os.path.isfile(path):
+            compile_error("Question bank not found: " + path)
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def load_index(self):
+        """Reads the saved index, unless it is missing or out of date.
+        Returns whether it was read."""
+        # the index holds arrays of integers in a marshalled dict, which
+        # loads far faster than JSON for banks of thousands of questions
+        import marshal
+        from array import array
+        try:
+            with open(self.index_path, 'rb') as filein:
+                index = marshal.load(filein)
+            if index["version"] != (Bank.version, sys.version_info[:2]) \
+                    or index["signature"] != self.signature:
+                return False
+            self.type = index["type"]
+            self.offsets = array('q', index["offsets"])
+            self.sizes = array('q', index["sizes"])
+            self.linenos = array('q', index["linenos"])
+            self.groups = {key: {value: array('q', ids)
+                                 for value, ids in group.items()}
+                           for key, group in index["groups"].items()}
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            return False
+        return True
+
+    def save_index(self):
+        import marshal
+        from array import array
+        index = {"version": (Bank.version, sys.version_info[:2]),
+                 "signature": self.signature, "type": self.type,
+                 "offsets": array('q', self.offsets).tobytes(),
+                 "sizes": array('q', self.sizes).tobytes(),
+                 "linenos": array('q', self.linenos).tobytes(),
+                 "groups": {key: {value: array('q', ids).tobytes()
+                                  for value, ids in group.items()}
+                            for key, group in self.groups.items()}}
+        try:
+            tmp = tmp_path(self.index_path)
+            with open(tmp, 'wb') as fileout:
+                marshal.dump(index, fileout)
+            os.replace(tmp, self.index_path)
+        except OSError:
+            pass
+
+    def build_index(self, errors=None, lines=None):
+        """Records the byte offset, size and line number of each question
+        of the file, or of lines if given.
+        The questions are grouped by each of their tags, their difficulty
+        and their points, so filtering never looks at every question.
+        Errors are collected in errors, if it is a list, and the lines
+        they are on skipped."""
+        self.type = None
+        self.offsets = []
+        self.sizes = []
+        self.linenos = []
+        self.groups = {key: {} for key in Bank.filters}
+        options = {}
+        in_question = False
+        offset = 0
+        filein = open(self.path, 'rb') if lines is None else None
+        try:
+            for lineno, raw in enumerate(filein or lines, 1):
+                line = raw.decode()
+                try:
+                    if line.strip() == "":
+                        pass
+                    elif self.type is None:
+                        match = re.match(
+                            r"(?i)\s*\[(match|tf|mc|frq)\]\s*$", line)
+                        if not match:
+                            compile_error("Question bank {} must start with "
+                                          "a section header.".format(
+                                              self.path), line, lineno)
+                        self.type = match.group(1).lower()
+                    elif re.match(r"\s", line):
+                        if in_question is None:
+                            # indented under a line with an error
+                            pass
+                        elif not in_question:
+                            compile_error("Bad indent.", line, lineno)
+                        else:
+                            self.sizes[-1] = \
+                                offset + len(raw) - self.offsets[-1]
+                    elif line.startswith("@"):
+                        try:
+                            key, val = line[1:].split("::")
+                        except ValueError:
+                            compile_error("Options must have 'key:: value' "
+                                          "structure.", line, lineno)
+                        options[key.strip().lower()] = [
+                            x.strip() for x in val.strip().split(";;")]
+                        in_question = False
+                    elif re.match(Section.module_ptrn, line) or \
+                            re.match(Section.bang_ptrn, line):
+                        compile_error("Question banks can only hold "
+                                      "questions.", line, lineno)
+                    else:
+                        match = re.match(r"{(\d*\.?\d+)}", line)
+                        if "points" not in options and self.type == "frq" \
+                                and match:
+                            options["points"] = [match.group(1)]
+                        values = {"tags": options.get("tags", []),
+                                  "difficulty":
+                                      options.get("difficulty", [])[:1],
+                                  "points": options.get("points", [])[:1]}
+                        for key in Bank.filters:
+                            for value in values[key]:
+                                value = Bank.normalize(key, value, lineno)
+                                self.groups[key].setdefault(
+                                    value, []).append(len(self.offsets))
+                        self.offsets.append(offset)
+                        self.sizes.append(len(raw))
+                        self.linenos.append(lineno)
+                        options = {}
+                        in_question = True
+                except ExamError as e:
+                    if errors is None or self.type is None:
+                        raise
+                    errors.append(e)
+                    options = {}
+                    in_question = None
+                offset += len(raw)
+        finally:
+            if filein:
+                filein.close()
+        if self.type is None:
+            compile_error("Question bank {} is empty.".format(self.path))
+
+    def normalize(key, value, lineno=None):
+        """Returns the form a tag, difficulty or point value is indexed
+        under: lowercase, and points as a number, so that 2 matches 2.0."""
+        if key == "points":
+            try:
+                return repr(float(value))
+            except ValueError:
+                compile_error("Points must be a number.", value, lineno)
+        return value.lower()
+
+    def select(self, filters):
+        """Returns the positions of the questions matching every filter,
+        a dict from filter name to the values allowed."""
+        selected = None
+        for key in Bank.filters:
+            if not filters.get(key):
+                continue
+            matches = set()
+            for value in filters[key]:
+                matches.update(self.groups[key].get(value, []))
+            selected = matches if selected is None else selected & matches
+        if selected is None:
+            return list(range(len(self.offsets)))
+        return sorted(selected)
+
+    def load(self, indices, section_type):
+        """Parses the questions at the given positions of the index that
+        are not parsed yet, reading only their lines of the bank, unless
+        they were saved parsed."""
+        basedir = os.path.dirname(self.path)
+        with self.lock:
+            missing = [i for i in sorted(set(indices))
+                       if i not in self.parsed]
+            if missing:
+                self.load_missing(missing, section_type, basedir)
+
+    def load_missing(self, missing, section_type, basedir):
+        """Parses the questions at the positions missing, with
+        self.lock held."""
+        import marshal
+        if self.ast_ids is None:
+            self.load_ast()
+        parsed = False
+        with open(self.path, 'rb') as filein, PausedGC():
+            for i in missing:
+                k = self.ast_slots.get(i)
+                if k is not None:
+                    data = self.ast_blob[self.ast_offsets[k]:
+                                         self.ast_offsets[k+1]]
+                    self.parsed[i] = content_from_data(
+                        [marshal.loads(data)], basedir)[0]
+                    continue
+                filein.seek(self.offsets[i])
+                lines = filein.read(self.sizes[i]).decode().splitlines(True)
+                source = Source(lines, basedir, self.linenos[i])
+                cur = Cursor(source, 0, len(source.lines))
+                self.parsed[i] = section_type.gobble(cur)
+                parsed = True
+        if parsed:
+            self.save_ast()
+
+    def load_ast(self):
+        """Reads the questions saved parsed, unless the bank changed since.
+        Each question's data is marshalled on its own, so that only the
+        questions drawn are unmarshalled."""
+        from array import array
+        self.ast_ids = array('q')
+        self.ast_offsets = array('q', [0])
+        self.ast_blob = memoryview(b"")
+        saved = load_ast(self.ast_path)
+        if saved is not None and saved["signature"] == self.signature:
+            self.ast_ids = array('q', saved["ids"])
+            self.ast_offsets = array('q', saved["offsets"])
+            self.ast_blob = memoryview(saved["blob"])
+        self.ast_slots = dict(zip(self.ast_ids, range(len(self.ast_ids))))
+
+    def save_ast(self):
+        """Saves the data of every question parsed so far."""
+        import marshal
+        from array import array
+        blobs = {i: self.ast_blob[self.ast_offsets[k]:self.ast_offsets[k+1]]
+                 for k, i in enumerate(self.ast_ids)}
+        for i, question in self.parsed.items():
+            if i not in blobs:
+                blobs[i] = marshal.dumps(content_data([question])[0])
+        self.ast_ids = array('q', sorted(blobs))
+        self.ast_offsets = array('q', [0])
+        for i in self.ast_ids:
+            self.ast_offsets.append(self.ast_offsets[-1] + len(blobs[i]))
+        self.ast_blob = memoryview(b"".join(blobs[i] for i in self.ast_ids))
+        self.ast_slots = dict(zip(self.ast_ids, range(len(self.ast_ids))))
+        save_ast({"signature": self.signature,
+                  "ids": self.ast_ids.tobytes(),
+                  "offsets": self.ast_offsets.tobytes(),
+                  "blob": self.ast_blob.tobytes()}, self.ast_path)
+
+
+def load_bank(path, save=True):
+    """Returns the Bank at path, reusing the one already loaded unless the
+    file changed since. Its index is only saved if save is set (see
+    Bank), or else by the first later load that saves."""
+    path = os.path.abspath(path)
+    with shared_lock:
+        bank = banks.get(path)
+        if bank is None or bank.signature != Bank.stat(path):
+            bank = Bank(path, save=save)
+            banks[path] = bank
+        elif save and bank.unsaved:
+            bank.save_index()
+            bank.unsaved = False
+    return bank
+
+
+class Pool:
+    """The questions a section draws from the banks in its Pool option:
+    those matching its Tags, Difficulty and Points options, if given. Each
+    render draws Draw:: K of them (all of them if Draw is not given) with
+    its own seed. The banks' indexes are only saved if save is set."""
+
+    def __init__(self, options, section_type, basedir, lineno, save=True):
+        self.section_type = section_type
+        filters = {key: [Bank.normalize(key, v, lineno)
+                         for v in options.get(key, [])]
+                   for key in Bank.filters}
+        self.candidates = []
+        for path in options["pool"]:
+            bank = load_bank(os.path.join(basedir, path), save)
+            if Exam.section_types[bank.type] is not section_type:
+                compile_error("Question bank {} holds {} questions, not {}."
+                              .format(path, bank.type,
+                                      section_type.__name__.lower()),
+                              lineno=lineno)
+            self.candidates += [(bank, i) for i in bank.select(filters)]
+        self.count = len(self.candidates)
+        if "draw" in options:
+            try:
+                self.count = int(options["draw"][0])
+            except ValueError:
+                compile_error("Draw option must be an integer.",
+                              lineno=lineno)
+            if not 0 <= self.count <= len(self.candidates):
+                compile_error("Cannot draw {} questions from a pool of {}."
+                              .format(self.count, len(self.candidates)),
+                              lineno=lineno)
+
+    def draw(self, rng):
+        """Returns the questions drawn with rng, in the order drawn."""
+        import copy
+        drawn = rng.sample(self.candidates, self.count)
+        by_bank = {}
+        for bank, i in drawn:
+            by_bank.setdefault(bank, []).append(i)
+        for bank, indices in by_bank.items():
+            bank.load(indices, self.section_type)
+        # copies, since shuffling changes a question and the bank's
+        # questions are shared by every exam drawing from it
+        return [copy.copy(bank.parsed[i]) for bank, i in drawn]
+
 
-    def __init__(self, lines):
-        sep = np.flatnonzero([re.match("-----", l) for l in lines])
-        if sep.size != 0:
-            sep = sep[0]
-            self.options = process_options(lines[:sep])
-            self.lines = lines[sep+1:]
+class Section:
+    module_ptrn = r"(?i){(image|text|latex)}\s*$"
+    bang_ptrn = r"(?i)\s*!(newpage|gap|newcol|hrule)"
+    __slots__ = ("lineno", "options", "content", "parsed", "pool")
+
+    def __init__(self, cur):
+        self.lineno = cur.lineno()
+        sep = cur.find("-----")
+        if sep is not None:
+            self.options = process_options(cur.upto(sep))
+            cur.take()
         else:
             self.options = {}
-            self.lines = lines
         self.content = []
+        self.parsed = None
 
         options = self.options
         if "name" in options:
             options["name"] = options["name"][0]
         else:
             options["name"] = None
-
-    def gobble(lines):
-        module_ptrn = r"(?i){(image|text|latex)}\s*$"
-        bang_ptrn = r"(?i)\s*!(newpage|gap|newcol|hrule)"
-        cont = lines[0]
-        if re.match(module_ptrn, cont):
+        self.pool = None
+        if "pool" in options:
+            try:
+                # checking writes nothing (see check_exam)
+                self.pool = Pool(options, type(self), cur.source.basedir,
+                                 self.lineno, cur.source.errors is None)
+            except ExamError as e:
+                cur.source.report(e)
+
+    def gobble(cur):
+        cont = cur.peek()
+        if re.match(Section.module_ptrn, cont):
             module_type = cont.strip().lower()[1:-1]
-            end = 1
-            while end < len(lines) and re.match(r"\s", lines[end]):
-                end += 1
-            if end == 1:
-                compile_error("Empty module.", cont)
-            cont = lines[1:end]
+            lineno = cur.lineno()
+            cont, block = cur.take_block()
+            if not block:
+                compile_error("Empty module.", cont, lineno)
             if module_type == "image":
-                return Image(cont), lines[end:]
+                return Image(block)
             elif module_type == "text":
-                return Text(cont), lines[end:]
+                return Text(block)
             elif module_type == "latex":
-                return Latex(cont), lines[end:]
-        elif re.match(bang_ptrn, cont):
-            return Bang(cont), lines[1:]
-        return None, lines
+                return Latex(block)
+        elif re.match(Section.bang_ptrn, cont):
+            return Bang(cur.take())
+        return None
+
+    def is_question(self, cont):
+        return False
+
+    def shuffle(self, rng, questions=False):
+        """Restores the parsed order and appends the questions drawn from
+        the pool, then shuffles each run of consecutive questions if
+        questions is set. Modules and bangs stay in place."""
+        if self.parsed is None:
+            self.parsed = list(self.content)
+        content = list(self.parsed)
+        if self.pool:
+            content += self.pool.draw(rng)
+        self.content = content
+        if not questions:
+            return
+        start = 0
+        while start < len(content):
+            end = start
+            while end < len(content) and self.is_question(content[end]):
+                end += 1
+            if end > start:
+                run = content[start:end]
+                rng.shuffle(run)
+                content[start:end] = run
+            start = end + 1
+
+    def answers(self):
+        """Returns the answer letter of each question in order, or None
+        for questions without one."""
+        return []
+
+    def points(self):
+        """Returns the points each question is worth in order, or None
+        where they are not given."""
+        return [None for a in self.answers()]
+
+    def image_modules(self):
+        """Returns the Image modules in this section."""
+        return [cont for cont in self.content if type(cont) == Image]
+
+    def images(self):
+        """Returns the paths of the images in this section."""
+        return [img.img_path for img in self.image_modules()]
+
+    def count(self):
+        """Returns the number of questions in this section."""
+        return len([cont for cont in self.content if self.is_question(cont)])
+
+    def to_tex(self, start=0, answer_sheet=False):
+        """Returns the section's tex, numbering its questions from
+        start + 1. FRQ answers are left out if answer_sheet."""
+        return ""
 
-    def to_tex(self):
+    def ans_sheet_tex(self, start=0):
+        return ""
+
+    def to_html(self, start=0, answer_sheet=False):
+        """Returns the section's HTML, like to_tex. Answers are always
+        marked up, and shown only on pages with answers (see
+        Exam.html_page)."""
         return ""
 
-    def ans_sheet_tex(self):
+    def ans_sheet_html(self, start=0):
         return ""
 
+    def questions_html(self, start, question_html):
+        """Returns the HTML of the content, with each run of questions
+        (rendered by question_html) in a list numbered from start + 1."""
+        num = start
+        html = []
+        in_questions = False
+        for cont in self.content:
+            if self.is_question(cont):
+                if not in_questions:
+                    in_questions = True
+                    html.append('<ol class="questions" start="{}">'
+                                .format(num + 1))
+                num += 1
+                html.append(question_html(cont))
+            else:
+                if in_questions:
+                    in_questions = False
+                    html.append("</ol>")
+                html.append(cont.to_html())
+        if in_questions:
+            html.append("</ol>")
+        return html
+
+    def heading_html(self):
+        html = ['<section class="{}">'.format(self.tag)]
+        if self.options["name"]:
+            html.append("<h2>{}</h2>".format(htmlify(self.options["name"])))
+        return html
+
+    def blanks_html(self, start):
+        """Returns the answer blanks of the questions, numbered from start +
+        1, with their answers."""
+        html = ['<ol class="blanks" start="{}">'.format(start + 1)]
+        for sol in self.answers():
+            html.append('<li><span class="blank"><span class="answer">{}'
+                        '</span></span></li>'.format(sol))
+        html.append("</ol>")
+        return "\n".join(html)
+
+    def __getstate__(self):
+        # sections are sent to render workers once shuffled, when the
+        # questions drawn from the pool are already in content
+        state = {name: getattr(self, name) for cls in type(self).__mro__
+                 for name in getattr(cls, "__slots__", ())}
+        state["pool"] = None
+        state["parsed"] = None
+        return None, state
+
+    def to_data(self, base=0):
+        """Returns the section as lists, strings and numbers (see
+        node_from_data), in its current order, with its line numbers
+        counted from base. If it was shuffled, the positions of its parsed
+        content come along."""
+        parsed = None
+        if self.parsed is not None:
+            positions = {id(cont): i for i, cont in enumerate(self.content)}
+            parsed = [positions[id(cont)] for cont in self.parsed]
+        return [self.tag, self.lineno - base, self.options,
+                content_data(self.content, base), parsed]
+
+    def load_data(self, data, basedir, base=0):
+        lineno, self.options, content, parsed = data[1:5]
+        self.lineno = lineno + base
+        self.content = content_from_data(content, basedir, base)
+        self.parsed = None
+        if parsed is not None:
+            self.parsed = [self.content[i] for i in parsed]
+        self.pool = None
+        if "pool" in self.options:
+            self.pool = Pool(self.options, type(self), basedir, self.lineno)
+
 
 class Cover(Section):
+    tag = "cover"
+    __slots__ = ()
 
-    def __init__(self, lines):
-        Section.__init__(self, lines)
-        lines = self.lines
-        while lines:
-            cont, lines = Cover.gobble(lines)
-            self.content.append(cont)
+    def __init__(self, cur):
+        Section.__init__(self, cur)
+        self.content = gobble_all(cur, Cover.gobble)
 
-    def gobble(lines):
-        cont, lines = Section.gobble(lines)
+    def gobble(cur):
+        cont = Section.gobble(cur)
         if cont:
-            return cont, lines
+            return cont
+        lineno = cur.lineno()
+        line = cur.take()
         try:
-            key, val = lines[0].split('::')
+            key, val = line.split('::')
         except ValueError:
-            compile_error("Error in Cover. Each line must have exactly\
-                one double colon.", lines[0])
+            compile_error("Error in Cover. Each line must have exactly "
+                          "one double colon.", line, lineno)
         val = [v.strip() for v in val.split(";;")]
-        cont = (key.strip().lower(), val)
-        return cont, lines[1:]
+        return (key.strip().lower(), val)
 
-    def to_tex(self):
+    def to_tex(self, start=0, answer_sheet=False):
         tex = []
         for cont in self.content:
             if type(cont) == tuple:
@@ -162,23 +916,72 @@ class Cover(Section):
                 tex.append(cont.to_tex())
         return "\n".join(tex)
 
+    def to_html(self, start=0, answer_sheet=False):
+        html = ['<section class="cover">']
+        for cont in self.content:
+            if type(cont) == tuple:
+                key, val = cont
+                if key == "title":
+                    html.append("<h1>{}</h1>".format(htmlify(val[0])))
+                if key == "subtitle":
+                    html.append('<p class="subtitle">{}</p>'
+                                .format(htmlify(val[0])))
+                if key == "id":
+                    html.append('<table class="id">')
+                    for v in val:
+                        html.append('<tr><th>{}:</th><td class="line"></td>'
+                                    '</tr>'.format(htmlify(v)))
+                    html.append("</table>")
+                if key == "author":
+                    html.append('<table class="author">')
+                    for i in range(len(val)):
+                        firstcol = "Written by:" if i == 0 else ""
+                        html.append("<tr><th>{}</th><td>{}</td></tr>"
+                                    .format(firstcol, htmlify(val[i])))
+                    html.append("</table>")
+            else:
+                html.append(cont.to_html())
+        html.append("</section>")
+        return "\n".join(html)
+
 
 class MatchTF(Section):
+    __slots__ = ("wordbank",)
 
-    def gobble(lines):
-        cont, lines = Section.gobble(lines)
+    def gobble(cur):
+        cont = Section.gobble(cur)
         if cont:
-            return cont, lines
+            return cont
+        lineno = cur.lineno()
+        line = cur.take()
         try:
-            ans, ques = lines[0].split('::')
+            ans, ques = line.split('::')
         except ValueError:
-            compile_error("Error in Match/TF. Each line must have exactly\
-                one double colon.", lines[0])
-        cont = (ques.strip(), ans.strip())
-        return cont, lines[1:]
+            compile_error("Error in Match/TF. Each line must have exactly "
+                          "one double colon.", line, lineno)
+        return (ques.strip(), ans.strip())
 
-    def to_tex(self):
-        global qcount
+    def is_question(self, cont):
+        return type(cont) == tuple
+
+    def answer(self, a):
+        if self.wordbank:
+            return chr(65 + self.wordbank.index(a))
+        return 'T' if a.lower() in ["t", "true"] else 'F'
+
+    def answers(self):
+        return [self.answer(cont[1]) for cont in self.content
+                if type(cont) == tuple]
+
+    def to_data(self, base=0):
+        return Section.to_data(self, base) + [self.wordbank]
+
+    def load_data(self, data, basedir, base=0):
+        Section.load_data(self, data, basedir, base)
+        self.wordbank = data[5]
+
+    def to_tex(self, start=0, answer_sheet=False):
+        num = start
         tex = ["\\newpage"]
         if self.options["name"]:
             tex.append("\\section*{{{}}}".format(self.options["name"]))
@@ -193,14 +996,11 @@ class MatchTF(Section):
                 if not in_questions:
                     in_questions = True
                     tex.append("\\begin{questions}")
-                    tex.append("\\setcounter{{question}}{{{}}}".format(qcount))
+                    tex.append("\\setcounter{{question}}{{{}}}".format(num))
                 q, a = cont
-                if self.wordbank:
-                    a = chr(65 + self.wordbank.index(a))
-                else:
-                    a = 'T' if a.lower() in ["t", "true"] else 'F'
+                a = self.answer(a)
                 tex.append("\\question\\match{{{}}}{{{}}}".format(a, q))
-                qcount += 1
+                num += 1
             else:
                 if in_questions:
                     in_questions = False
@@ -210,25 +1010,15 @@ class MatchTF(Section):
             tex.append("\\end{questions}")
         return "\n".join(tex)
 
-    def ans_sheet_tex(self):
-        global qcount
+    def ans_sheet_tex(self, start=0):
         tex = []
-        solutions = []
-        for cont in self.content:
-            if type(cont) == tuple:
-                q, a = cont
-                if self.wordbank:
-                    a = chr(65 + self.wordbank.index(a))
-                else:
-                    a = 'T' if a.lower() in ["t", "true"] else 'F'
-                solutions.append(a)
+        solutions = self.answers()
         tex.append("\\raggedcolumns")
         tex.append("\\begin{multicols}{5}")
         tex.append("\\begin{enumerate}")
-        tex.append("\t\\setcounter{{enumi}}{{{}}}".format(qcount))
+        tex.append("\t\\setcounter{{enumi}}{{{}}}".format(start))
         for sol in solutions:
             tex.append("\t\\item \\choiceblank{{{}}}".format(sol))
-            qcount += 1
         tex.append("\\end{enumerate}")
         # spacing needs fixing iff the columns are uneven in length.
         if len(solutions) % 5 != 0:
@@ -236,77 +1026,120 @@ class MatchTF(Section):
         tex.append("\\end{multicols}")
         return "\n".join(tex)
 
+    def to_html(self, start=0, answer_sheet=False):
+        html = self.heading_html()
+        if self.wordbank:
+            html.append('<ol class="wordbank">')
+            for ans in self.wordbank:
+                html.append("<li>{}</li>".format(htmlify(ans)))
+            html.append("</ol>")
+        html += self.questions_html(start, self.match_html)
+        html.append("</section>")
+        return "\n".join(html)
+
+    def match_html(self, cont):
+        q, a = cont
+        return ('<li class="question"><span class="blank"><span '
+                'class="answer">{}</span></span> {}</li>'.format(
+                    self.answer(a), htmlify(q)))
+
+    def ans_sheet_html(self, start=0):
+        return self.blanks_html(start)
+
 
 class Match(MatchTF):
+    tag = "match"
+    __slots__ = ()
+
+    def __init__(self, cur):
+        Section.__init__(self, cur)
+        self.content = gobble_all(cur, MatchTF.gobble)
+        try:
+            self.make_wordbank()
+        except ExamError as e:
+            cur.source.report(e)
 
-    def __init__(self, lines):
-        Section.__init__(self, lines)
-        lines = self.lines
+    def make_wordbank(self):
         wordbank = set()
-        while lines:
-            cont, lines = MatchTF.gobble(lines)
-            self.content.append(cont)
+        for cont in self.content:
             if type(cont) == tuple:
                 wordbank.add(cont[1])
         self.wordbank = sorted(list(wordbank))
         if len(self.wordbank) > 26:
-            compile_error("Too many choices in word bank.")
+            compile_error("Too many choices in word bank.",
+                          lineno=self.lineno)
+
+    def shuffle(self, rng, questions=False):
+        Section.shuffle(self, rng, questions)
+        if self.pool:
+            self.make_wordbank()
 
 
 class TF(MatchTF):
+    tag = "tf"
+    __slots__ = ()
 
-    def __init__(self, lines):
-        Section.__init__(self, lines)
+    def __init__(self, cur):
+        Section.__init__(self, cur)
         self.wordbank = None
-        lines = self.lines
-        while lines:
-            cont, lines = MatchTF.gobble(lines)
-            self.content.append(cont)
+        self.content = gobble_all(cur, MatchTF.gobble)
 
 
 class MC(Section):
+    tag = "mc"
+    __slots__ = ()
 
-    def __init__(self, lines):
-        Section.__init__(self, lines)
-        self.format_options()
-        lines = self.lines
-        while lines:
-            cont, lines = MC.gobble(lines)
-            self.content.append(cont)
+    def __init__(self, cur):
+        Section.__init__(self, cur)
+        self.format_options(cur.source)
+        self.content = gobble_all(cur, MC.gobble)
 
-    def format_options(self):
+    def format_options(self, source):
         options = self.options
         if "twocolumn" in options:
             twocol = options["twocolumn"][0].lower()
             if twocol not in ["true", "false"]:
-                compile_error("Twocolumn option must be boolean.")
+                source.report(ExamError("Twocolumn option must be boolean.",
+                                        lineno=self.lineno))
             options["twocolumn"] = (twocol == "true")
         else:
             options["twocolumn"] = False
         if "condense" in options:
             condense = options["condense"][0].lower()
             if condense not in ["true", "false"]:
-                compile_error("Condense option must be boolean.")
+                source.report(ExamError("Condense option must be boolean.",
+                                        lineno=self.lineno))
             options["condense"] = (condense == "true")
         else:
             options["condense"] = False
 
-    def gobble(lines):
-        cont, lines = Section.gobble(lines)
+    def gobble(cur):
+        cont = Section.gobble(cur)
         if cont:
-            return cont, lines
-        question = lines[0].strip()
-        lines = lines[1:]
-        end = 0
-        while end < len(lines) and re.match(r"\s", lines[end]):
-            end += 1
-        choices = [l.strip() for l in lines[:end]]
-        MCQ = MC.MCQuestion(question, choices)
-        return MCQ, lines[end:]
+            return cont
+        lineno = cur.lineno()
+        question, block = cur.take_block()
+        choices = [l.strip() for l in block.lines()]
+        if not choices:
+            compile_error("MC question has no choices.", question.strip(),
+                          lineno)
+        return MC.MCQuestion(question.strip(), choices)
+
+    def is_question(self, cont):
+        return type(cont) == MC.MCQuestion
+
+    def shuffle(self, rng, questions=False):
+        Section.shuffle(self, rng, questions)
+        for cont in self.content:
+            if type(cont) == MC.MCQuestion:
+                cont.shuffle(rng)
 
-    def to_tex(self):
-        global qcount
-        initial_qcount = qcount
+    def answers(self):
+        return [cont.get_answer() for cont in self.content
+                if type(cont) == MC.MCQuestion]
+
+    def to_tex(self, start=0, answer_sheet=False):
+        num = start
         tex = ["\\newpage"]
         if self.options["name"]:
             tex.append("\\section*{{{}}}".format(self.options["name"]))
@@ -324,8 +1157,8 @@ class MC(Section):
                 if not in_questions:
                     in_questions = True
                     tex.append("\\begin{questions}")
-                    tex.append("\\setcounter{{question}}{{{}}}".format(qcount))
-                qcount += 1
+                    tex.append("\\setcounter{{question}}{{{}}}".format(num))
+                num += 1
             else:
                 if in_questions:
                     in_questions = False
@@ -338,24 +1171,31 @@ class MC(Section):
             tex.append("\\renewcommand{\\choiceshook}{}")
             tex.append("\\renewcommand{\\questionshook}{}")
         if self.options["condense"]:
-            qcount = initial_qcount
-            tex.append(self.ans_sheet_tex())
+            tex.append(self.ans_sheet_tex(start))
         return "\n".join(tex)
 
-    def ans_sheet_tex(self):
-        global qcount
+    def to_html(self, start=0, answer_sheet=False):
+        html = self.heading_html()
+        if self.options["twocolumn"]:
+            html[0] = '<section class="mc twocolumn">'
+        html += self.questions_html(start, MC.MCQuestion.to_html)
+        if self.options["condense"]:
+            html.append(self.ans_sheet_html(start))
+        html.append("</section>")
+        return "\n".join(html)
+
+    def ans_sheet_html(self, start=0):
+        return self.blanks_html(start)
+
+    def ans_sheet_tex(self, start=0):
         tex = []
-        solutions = []
-        for cont in self.content:
-            if type(cont) == MC.MCQuestion:
-                solutions.append(cont.get_answer())
+        solutions = self.answers()
         tex.append("\\raggedcolumns")
         tex.append("\\begin{multicols}{5}")
         tex.append("\\begin{enumerate}")
-        tex.append("\t\\setcounter{{enumi}}{{{}}}".format(qcount))
+        tex.append("\t\\setcounter{{enumi}}{{{}}}".format(start))
         for sol in solutions:
             tex.append("\t\\item \\choiceblank{{{}}}".format(sol))
-            qcount += 1
         tex.append("\\end{enumerate}")
         # spacing needs fixing iff the columns are uneven in length.
         if len(solutions) % 5 != 0:
@@ -364,6 +1204,9 @@ class MC(Section):
         return "\n".join(tex)
 
     class MCQuestion:
+        tag = "mcq"
+        __slots__ = ("question", "choices", "correct_choice", "randomize",
+                     "given", "order")
 
         def __init__(self, question, choices):
             self.question = question
@@ -376,10 +1219,31 @@ class MC(Section):
                     self.correct_choice = choice
                 self.choices.append(choice)
             # if correct choice not specified, first given answer is correct
-            if not self.correct_choice:
+            # and the choices are randomized by shuffle()
+            self.randomize = not self.correct_choice
+            if self.randomize:
                 self.correct_choice = self.choices[0]
-                # randomize choices
-                random.shuffle(self.choices)
+            self.given = list(self.choices)
+            # positions in given of the shuffled choices
+            self.order = None
+
+        def shuffle(self, rng):
+            if self.randomize:
+                self.order = list(range(len(self.given)))
+                rng.shuffle(self.order)
+                self.choices = [self.given[i] for i in self.order]
+
+        def to_data(self, base=0):
+            return ["mcq", self.question, self.given, self.correct_choice,
+                    self.randomize, self.order]
+
+        def load_data(self, data, basedir, base=0):
+            (self.question, self.given, self.correct_choice, self.randomize,
+             self.order) = data[1:6]
+            # shuffle replaces choices rather than changing it
+            self.choices = self.given
+            if self.order is not None:
+                self.choices = [self.given[i] for i in self.order]
 
         def get_answer(self):
             """Returns capital-letter character of correct answer choice."""
@@ -397,28 +1261,57 @@ class MC(Section):
             tex.append("\t\\end{choices}")
             return "\n".join(tex)
 
+        def to_html(self):
+            html = ['<li class="question">{}'.format(htmlify(self.question)),
+                    '<ol class="choices">']
+            for choice in self.choices:
+                correct = choice == self.correct_choice
+                html.append("<li{}>{}</li>".format(
+                    ' class="correct"' if correct else "", htmlify(choice)))
+            html.append("</ol></li>")
+            return "\n".join(html)
+
 
 class FRQ(Section):
+    tag = "frq"
+    __slots__ = ()
 
-    def __init__(self, lines):
-        Section.__init__(self, lines)
-        lines = self.lines
-        while lines:
-            cont, lines = FRQ.gobble(lines)
-            self.content.append(cont)
+    def __init__(self, cur):
+        Section.__init__(self, cur)
+        self.content = gobble_all(cur, FRQ.gobble)
 
-    def gobble(lines):
-        cont, lines = Section.gobble(lines)
+    def gobble(cur):
+        cont = Section.gobble(cur)
         if cont:
-            return cont, lines
-        end = 1
-        while end < len(lines) and re.match(r"\s", lines[end]):
-            end += 1
-        frq = FRQ.FRQuestion(lines[:end], 0)
-        return frq, lines[end:]
+            return cont
+        lineno = cur.lineno()
+        question, block = cur.take_block()
+        return FRQ.FRQuestion(question, lineno, block.deeper(), 0)
 
-    def to_tex(self):
-        global qcount
+    def is_question(self, cont):
+        return type(cont) == FRQ.FRQuestion
+
+    def shuffle(self, rng, questions=False):
+        # FRQ questions are never shuffled
+        Section.shuffle(self, rng)
+
+    def answers(self):
+        return [None for cont in self.content
+                if type(cont) == FRQ.FRQuestion]
+
+    def points(self):
+        return [cont.total_points() for cont in self.content
+                if type(cont) == FRQ.FRQuestion]
+
+    def image_modules(self):
+        images = Section.image_modules(self)
+        for cont in self.content:
+            if type(cont) == FRQ.FRQuestion:
+                images += cont.image_modules()
+        return images
+
+    def to_tex(self, start=0, answer_sheet=False):
+        num = start
         tex = ["\\newpage"]
         if self.options["name"]:
             tex.append("\\section*{{{}}}".format(self.options["name"]))
@@ -428,97 +1321,144 @@ class FRQ(Section):
                 if not in_questions:
                     in_questions = True
                     tex.append("\\begin{questions}")
-                    tex.append("\\setcounter{{question}}{{{}}}".format(qcount))
-                qcount += 1
+                    tex.append("\\setcounter{{question}}{{{}}}".format(num))
+                num += 1
+                tex.append(cont.to_tex(answer_sheet))
             else:
                 if in_questions:
                     in_questions = False
                     tex.append("\\end{questions}")
-            tex.append(cont.to_tex())
+                tex.append(cont.to_tex())
         if in_questions:
             tex.append("\\end{questions}")
         return "\n".join(tex)
 
-    def ans_sheet_tex(self):
-        global qcount
+    def ans_sheet_tex(self, start=0):
         tex = []
         tex.append("\\begin{questions}")
-        tex.append("\\setcounter{{question}}{{{}}}".format(qcount))
+        tex.append("\\setcounter{{question}}{{{}}}".format(start))
         for cont in self.content:
             if type(cont) == FRQ.FRQuestion:
                 tex.append(cont.ans_sheet_tex())
-                qcount += 1
         tex.append("\\end{questions}")
         return "\n".join(tex)
 
+    def to_html(self, start=0, answer_sheet=False):
+        html = self.heading_html()
+        html += self.questions_html(
+            start, lambda cont: cont.to_html(answer_sheet))
+        html.append("</section>")
+        return "\n".join(html)
+
+    def ans_sheet_html(self, start=0):
+        html = ['<ol class="questions" start="{}">'.format(start + 1)]
+        for cont in self.content:
+            if type(cont) == FRQ.FRQuestion:
+                html.append(cont.ans_sheet_html())
+        html.append("</ol>")
+        return "\n".join(html)
+
     class FRQuestion:
         partlabels = ['question', 'part', 'subpart', 'subsubpart']
+        tag = "frqq"
+        __slots__ = ("content", "level", "lineno", "point_val", "points",
+                     "question", "ans_height", "answer")
 
-        def __init__(self, lines, level):
+        def __init__(self, question, lineno, cur, level):
             self.content = []
             self.level = level
+            self.lineno = lineno
             self.point_val = ""
-            question = lines[0].strip()
+            self.points = None
+            # the answer of a question without parts
+            self.ans_height = None
+            self.answer = None
+            question = question.strip()
             match = re.match(r"{\d*\.?\d+}", question)
             if match:
                 self.point_val = "[{}]".format(match.group(0)[1:-1])
+                self.points = float(match.group(0)[1:-1])
                 question = question[match.end():].strip()
             self.question = question if question != "*" else ""
-            lines = FRQ.FRQuestion.unindent(lines[1:])
-            if len(lines) == 0:
-                compile_error("FRQ question missing answer.", self.question)
-            if len(lines) == 1 and re.match(r"\s*//", lines[0]):
-                line = lines[0].strip()[2:].strip()
+            if not cur:
+                compile_error("FRQ question missing answer.", self.question,
+                              lineno)
+            if len(cur) == 1 and re.match(r"\s*//", cur.peek()):
+                line = cur.take().strip()[2:].strip()
                 # solution height
                 match = re.match(r"{\d*\.?\d+}", line)
                 if match:
                     self.ans_height = int(float(match.group(0)[1:-1])*18)
                     line = line[match.end():]
                 else:
-                    self.ans_height = 18*np.ceil(len(line)/75)
+                    self.ans_height = 18.0*math.ceil(len(line)/75)
                 self.answer = line.strip()
             else:
-                while lines:
-                    frq, lines = FRQ.FRQuestion.gobble(lines, level)
-                    self.content.append(frq)
-
-        def unindent(lines):
-            unindented = []
-            for line in lines:
-                line = re.sub("\t", "    ", line)
-                if line[:4] != "    ":
-                    compile_error("Bad indent.", line)
-                unindented.append(line[4:])
-            return unindented
-
-        def gobble(lines, level):
-            cont, lines = Section.gobble(lines)
+                if level+1 >= len(FRQ.FRQuestion.partlabels):
+                    compile_error("FRQ too nested (subsubsubparts not "
+                                  "allowed.)", self.question, lineno)
+                self.content = gobble_all(cur, functools.partial(
+                    FRQ.FRQuestion.gobble, level=level))
+
+        def gobble(cur, level):
+            cont = Section.gobble(cur)
             if cont:
-                return cont, lines
-            if re.match(r"\s", lines[0]):
-                compile_error("Question overindented.", lines[0])
-            end = 1
-            while end < len(lines) and re.match(r"\s", lines[end]):
-                end += 1
-            frq = FRQ.FRQuestion(lines[:end], level+1)
-            return frq, lines[end:]
-
-        def to_tex(self):
+                return cont
+            lineno = cur.lineno()
+            if re.match(r"\s", cur.peek()):
+                compile_error("Question overindented.", cur.peek(), lineno)
+            question, block = cur.take_block()
+            return FRQ.FRQuestion(question, lineno, block.deeper(), level+1)
+
+        def to_data(self, base=0):
+            return ["frqq", self.lineno - base, self.level, self.question,
+                    self.point_val, self.points,
+                    content_data(self.content, base), self.ans_height,
+                    self.answer]
+
+        def load_data(self, data, basedir, base=0):
+            (lineno, self.level, self.question, self.point_val,
+             self.points, content, self.ans_height, self.answer) = data[1:9]
+            self.lineno = lineno + base
+            self.content = content_from_data(content, basedir, base)
+
+        def total_points(self):
+            """Returns the points given for this question, or else the
+            total of its parts, or None if there are none."""
+            if self.points is not None:
+                return self.points
+            parts = [cont.total_points() for cont in self.content
+                     if type(cont) == FRQ.FRQuestion]
+            parts = [p for p in parts if p is not None]
+            return sum(parts) if parts else None
+
+        def image_modules(self):
+            images = []
+            for cont in self.content:
+                if type(cont) == Image:
+                    images.append(cont)
+                elif type(cont) == FRQ.FRQuestion:
+                    images += cont.image_modules()
+            return images
+
+        def to_tex(self, answer_sheet=False):
+            """Returns the question's tex, with its answer unless it goes
+            on the answer sheet."""
             indent = "\t" * self.level
             qlabel = FRQ.FRQuestion.partlabels[self.level]
             tex = ["{}\\{}{} {}".format(indent, qlabel, self.point_val,
                    latexify(self.question))]
             if self.content:
-                if self.level+1 >= len(FRQ.FRQuestion.partlabels):
-                    compile_error("FRQ too nested (subsubsubparts not \
-                        allowed.)", self.question)
                 indent1 = "\t" * (self.level+1)
                 qlabel1 = FRQ.FRQuestion.partlabels[self.level+1] + "s"
                 tex.append("{}\\begin{{{}}}".format(indent1, qlabel1))
                 for cont in self.content:
-                    tex.append(cont.to_tex())
+                    if type(cont) == FRQ.FRQuestion:
+                        tex.append(cont.to_tex(answer_sheet))
+                    else:
+                        tex.append(cont.to_tex())
                 tex.append("{}\\end{{{}}}".format(indent1, qlabel1))
-            elif not exam.meta["answer sheet"]:
+            elif not answer_sheet:
                 indent1 = "\t" * (self.level+1)
                 tex.append(indent1 + "\\par")
                 tex.append("{}\\begin{{solution}}[{}pt]"
@@ -533,9 +1473,6 @@ class FRQ(Section):
             tex = []
             if self.content:
                 tex.append("{}\\{}".format(indent, qlabel))
-                if self.level+1 >= len(FRQ.FRQuestion.partlabels):
-                    compile_error("FRQ too nested (subsubsubparts not \
-                        allowed.)", self.question)
                 indent1 = "\t" * (self.level+1)
                 qlabel1 = FRQ.FRQuestion.partlabels[self.level+1] + "s"
                 tex.append("{}\\begin{{{}}}".format(indent1, qlabel1))
@@ -554,29 +1491,99 @@ class FRQ(Section):
                 tex.append(indent1 + "\\end{solution}")
             return "\n".join(tex)
 
+        def to_html(self, answer_sheet=False, number=None):
+            """Returns the question's HTML, like to_tex. Parts are given
+            their number, since modules between them are list items
+            too."""
+            html = ['<li class="question"{}>'.format(
+                ' value="{}"'.format(number) if number else "")]
+            if self.points is not None:
+                html.append('<span class="points">({:g} point{})</span>'
+                            .format(self.points,
+                                    "" if self.points == 1 else "s"))
+            html.append(htmlify(self.question))
+            if self.content:
+                html.append('<ol class="parts">')
+                part = 0
+                for cont in self.content:
+                    if type(cont) == FRQ.FRQuestion:
+                        part += 1
+                        html.append(cont.to_html(answer_sheet, part))
+                    else:
+                        html.append('<li class="module">{}</li>'
+                                    .format(cont.to_html()))
+                html.append("</ol>")
+            elif not answer_sheet:
+                html.append(self.solution_html())
+            html.append("</li>")
+            return "\n".join(html)
+
+        def ans_sheet_html(self):
+            if not self.content:
+                return '<li class="question">{}</li>'.format(
+                    self.solution_html())
+            html = ['<li class="question">', '<ol class="parts">']
+            for cont in self.content:
+                if type(cont) == FRQ.FRQuestion:
+                    html.append(cont.ans_sheet_html())
+            html.append("</ol></li>")
+            return "\n".join(html)
+
+        def solution_html(self):
+            return ('<div class="solution" style="min-height: {}pt"><span '
+                    'class="answer">{}</span></div>'.format(
+                        self.ans_height, htmlify(self.answer)))
+
+
+def unindent(lines, linenos):
+    unindented = []
+    for line, lineno in zip(lines, linenos):
+        line = line.replace("\t", "    ")
+        if line[:4] != "    ":
+            compile_error("Bad indent.", line, lineno)
+        unindented.append(line[4:])
+    return unindented
 
-class Module:
 
-    def __init__(self, lines):
-        sep = np.flatnonzero([re.match(r"\s*-----", l) for l in lines])
-        if sep.size != 0:
-            sep = sep[0]
-            self.options = process_options(lines[:sep])
-            self.lines = lines[sep+1:]
+class Module:
+    __slots__ = ("lineno", "options", "linenos", "lines", "content")
+
+    def __init__(self, cur):
+        self.lineno = cur.lineno()
+        sep = cur.find(r"\s*-----")
+        if sep is not None:
+            self.options = process_options(cur.upto(sep))
+            cur.take()
         else:
             self.options = {}
-            self.lines = lines
+        self.linenos = cur.source.linenos[cur.pos:cur.end]
+        self.lines = cur.lines()
+        self.content = []
+
+    def to_data(self, base=0):
+        return [self.tag, self.lineno - base, self.options,
+                [lineno - base for lineno in self.linenos], self.lines]
+
+    def load_data(self, data, basedir, base=0):
+        lineno, self.options, linenos, self.lines = data[1:5]
+        self.lineno = lineno + base
+        self.linenos = [lineno + base for lineno in linenos]
         self.content = []
 
 
 class Image(Module):
+    tag = "image"
+    __slots__ = ("img_path", "copy", "basedir")
 
-    def __init__(self, lines):
-        Module.__init__(self, lines)
+    def __init__(self, cur):
+        Module.__init__(self, cur)
         self.format_options()
         if len(self.lines) == 0:
-            compile_error("Image missing filepath.")
+            compile_error("Image missing filepath.", lineno=self.lineno)
         self.img_path = self.lines[0].strip()
+        # the path of the copy prepared by an ImageCache, if any
+        self.copy = None
+        self.basedir = cur.source.basedir
 
     def format_options(self):
         options = self.options
@@ -588,19 +1595,50 @@ class Image(Module):
         else:
             options["width"] = "\\textwidth"
 
+    def load_data(self, data, basedir, base=0):
+        Module.load_data(self, data, basedir, base)
+        self.img_path = self.lines[0].strip()
+        self.copy = None
+        self.basedir = basedir
+
+    def check(self, basedir):
+        if find_image(os.path.join(basedir, self.img_path)) is None:
+            return [ExamError("Image not found: " + self.img_path,
+                              lineno=self.lineno)]
+        return []
+
     def to_tex(self):
         img_str = "\t\\includegraphics[width={}]{{{}}}".format(
-                self.options["width"], self.img_path)
+                self.options["width"], self.copy or self.img_path)
         tex = ["\\begin{center}"]
         tex.append(img_str)
         tex.append("\\end{center}")
         return "\n".join(tex)
 
+    def to_html(self):
+        """Returns the image's HTML. Its path is relative to the exam, as is
+        the page's."""
+        src = image_src(self.basedir, self.img_path)
+        width = self.options["width"]
+        if width.endswith("\\textwidth"):
+            factor = width[:-len("\\textwidth")]
+            width = "{:g}%".format(float(factor or 1) * 100)
+        if src.lower().endswith(".pdf"):
+            img = '<object data="{}" type="application/pdf"'.format(
+                html_attr(src))
+            img += ' style="width: {}"></object>'.format(html_attr(width))
+        else:
+            img = '<img src="{}" style="width: {}" alt="">'.format(
+                html_attr(src), html_attr(width))
+        return '<div class="image">{}</div>'.format(img)
+
 
 class Text(Module):
+    tag = "text"
+    __slots__ = ()
 
-    def __init__(self, lines):
-        Module.__init__(self, lines)
+    def __init__(self, cur):
+        Module.__init__(self, cur)
 
     def to_tex(self):
         tex = ["\\par\\noindent"]
@@ -610,24 +1648,70 @@ class Text(Module):
         tex = tex[:-1]
         return "\n".join(tex)
 
+    def to_html(self):
+        return "\n".join("<p>{}</p>".format(htmlify(l.strip()))
+                         for l in self.lines)
+
 
 class Latex(Module):
+    tag = "latex"
+    __slots__ = ()
 
-    def __init__(self, lines):
-        Module.__init__(self, lines)
+    def __init__(self, cur):
+        Module.__init__(self, cur)
 
     def to_tex(self):
-        lines = FRQ.FRQuestion.unindent(self.lines)
+        lines = unindent(self.lines, self.linenos)
         return "".join(lines)
 
+    def to_html(self):
+        """Returns the module's source, in which KaTeX renders any display
+        math."""
+        lines = unindent(self.lines, self.linenos)
+        source = "".join(lines).replace("&", "&amp;").replace("<", "&lt;")
+        return '<div class="latex">{}</div>'.format(source.rstrip("\n"))
+
+    def check(self, basedir):
+        """Returns the errors in the module's indentation or, since LaTeX
+        only reports them pages later, its braces. Escaped braces and
+        comments are skipped."""
+        try:
+            lines = unindent(self.lines, self.linenos)
+        except ExamError as e:
+            return [e]
+        opened = []
+        for line, lineno in zip(lines, self.linenos):
+            code = re.sub(r"\\[\\{}%]", "", line).split("%")[0]
+            for char in code:
+                if char == "{":
+                    opened.append((line, lineno))
+                elif char == "}":
+                    if not opened:
+                        return [ExamError("Unbalanced braces: unmatched }.",
+                                          line.strip(), lineno)]
+                    opened.pop()
+        if opened:
+            line, lineno = opened[-1]
+            return [ExamError("Unbalanced braces: unclosed {.",
+                              line.strip(), lineno)]
+        return []
+
 
 class Bang:
+    tag = "bang"
+    __slots__ = ("bang", "options")
 
     def __init__(self, line):
         line = line.strip().split()
         self.bang = line[0].lower()
         self.options = line[1:]
 
+    def to_data(self, base=0):
+        return ["bang", self.bang, self.options]
+
+    def load_data(self, data, basedir, base=0):
+        self.bang, self.options = data[1:3]
+
     def to_tex(self):
         if self.bang == "!newpage":
             return "\\newpage"
@@ -640,48 +1724,923 @@ class Bang:
                 return "\\vspace{{{}}}".format(self.options[0])
             return "\\vspace{0.10in}"
 
+    def to_html(self):
+        if self.bang == "!newpage":
+            return '<div class="newpage"></div>'
+        if self.bang == "!newcol":
+            return '<div class="newcol"></div>'
+        if self.bang == "!hrule":
+            return "<hr>"
+        if self.bang == "!gap":
+            height = self.options[0] if self.options else "0.10in"
+            return '<div style="height: {}"></div>'.format(html_attr(height))
+
+
+# node classes by the tag their data starts with
+node_types = {node_type.tag: node_type for node_type in [
+    Cover, Match, TF, MC, MC.MCQuestion, FRQ, FRQ.FRQuestion, Image, Text,
+    Latex, Bang]}
+
+
+def check_content(content, basedir):
+    """Returns the errors check finds in content and the FRQ parts in it:
+    those of its Image and Latex modules, which parsing does not look
+    into."""
+    errors = []
+    for cont in content:
+        if type(cont) == FRQ.FRQuestion:
+            errors += check_content(cont.content, basedir)
+        elif type(cont) in (Image, Latex):
+            errors += cont.check(basedir)
+    return errors
+
+
+def content_data(content, base=0):
+    """Returns the data of each of content: nodes as their to_data, and
+    Match/TF questions and Cover fields (tuples) as ["pair", a, b]."""
+    return [["pair", cont[0], cont[1]] if type(cont) == tuple
+            else cont.to_data(base) for cont in content]
+
+
+def content_from_data(data, basedir, base=0):
+    return [(d[1], d[2]) if d[0] == "pair"
+            else node_from_data(d, basedir, base) for d in data]
+
+
+def node_from_data(data, basedir="", base=0):
+    """Rebuilds a parsed node (a section, question, module or bang) from
+    its to_data, a list starting with its tag, without parsing anything.
+    Pool sections load their banks, which are relative to basedir. The
+    node's line numbers were counted from base."""
+    node_type = node_types[data[0]]
+    node = node_type.__new__(node_type)
+    node.load_data(data, basedir, base)
+    return node
+
+
+class PausedGC:
+    """Turns the cyclic garbage collector off inside a with block. Loading
+    parse trees creates many containers but no cycles, and the collections
+    they would trigger take longer than the loading itself."""
+
+    def __enter__(self):
+        import gc
+        self.enabled = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *exc):
+        import gc
+        if self.enabled:
+            gc.enable()
+
+
+def tmp_path(path):
+    """Returns the name to write path under before replacing it: one of
+    its own for each process and thread, since concurrent builds may
+    write the same files."""
+    return "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+
+
+def save_ast(data, path):
+    """Writes data, e.g. from Exam.to_data, to path: as JSON if
+    path ends in .json, for other tools, else in marshal's binary format,
+    tagged with Exam.ast_version and the Python version."""
+    import marshal
+    tmp = tmp_path(path)
+    try:
+        if path.endswith(".json"):
+            with open(tmp, 'w') as fileout:
+                json.dump(data, fileout)
+        else:
+            with open(tmp, 'wb') as fileout:
+                marshal.dump({"version": (Exam.ast_version,
+                                          sys.version_info[:2]),
+                              "data": data}, fileout)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+
+
+def load_ast(path):
+    """Returns the data save_ast wrote to path in binary, or None if it is
+    missing, unreadable or of another version."""
+    import marshal
+    try:
+        with open(path, 'rb') as filein:
+            # unmarshalling from bytes is several times faster than from
+            # the file object
+            data = filein.read()
+        with PausedGC():
+            saved = marshal.loads(data)
+        if saved["version"] != (Exam.ast_version, sys.version_info[:2]):
+            return None
+        return saved["data"]
+    except (OSError, EOFError, ValueError, TypeError, KeyError):
+        return None
+
+
+class Cache:
+    """Rendered section fragments, stored as one JSON file per key in a
+    directory. Once the directory grows past max_bytes, the least
+    recently used entries are evicted. The memory_entries most recently
+    used are also kept in memory, so that a long-running process (e.g.
+    a watch) stays small. Builds running concurrently may share a
+    Cache."""
+
+    # bump whenever the fragment format changes
+    version = 2
+
+    def __init__(self, path, max_bytes=64 * 2**20, memory_entries=32):
+        from collections import OrderedDict
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        # entries read or written by this process, least recently used
+        # first
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(*parts):
+        digest = hashlib.sha256()
+        for part in (Cache.version,) + parts:
+            digest.update(str(part).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.path, key + ".json")
+        with self.lock:
+            try:
+                if key in self.memory:
+                    entry = self.memory[key]
+                else:
+                    with open(path, 'r') as filein:
+                        entry = json.load(filein)
+                os.utime(path)
+            except (OSError, ValueError):
+                self.memory.pop(key, None)
+                return None
+            self.remember(key, entry)
+            return entry
+
+    def put(self, key, entry):
+        path = os.path.join(self.path, key + ".json")
+        with self.lock:
+            self.remember(key, entry)
+            try:
+                os.makedirs(self.path, exist_ok=True)
+                tmp = tmp_path(path)
+                with open(tmp, 'w') as fileout:
+                    json.dump(entry, fileout)
+                os.replace(tmp, path)
+            except OSError:
+                pass
+
+    def remember(self, key, entry):
+        """Keeps entry in memory as the most recently used, forgetting
+        the least recently used beyond memory_entries."""
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+    def evict(self):
+        with self.lock:
+            try:
+                entries = [e for e in os.scandir(self.path)
+                           if e.name.endswith(".json")]
+                entries = [(e.stat().st_mtime, e.stat().st_size, e.path)
+                           for e in entries]
+            except OSError:
+                return
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    # evicted by another process already
+                    pass
+                self.memory.pop(os.path.basename(path)[:-5], None)
+                total -= size
+
+
+class Metrics:
+    """Wall times and counts of one build: per stage, per rendered section
+    and per document. Instrumented code only records anything while
+    state.metrics is set, so an unmeasured build pays one truth test per
+    stage."""
+
+    stage_names = ["import", "read", "scan", "parse", "render", "write",
+                   "format", "latexmk", "build"]
+
+    def __init__(self):
+        # stage: [seconds, count]
+        self.stages = {}
+        self.sections = []
+        # tex file: dict of fields
+        self.documents = {}
+        # the latexify cache is shared, so the build's lookups are the
+        # difference from its counts when the build started (which also
+        # counts those of builds running at the same time)
+        self.latexify_start = latexify.cache_info()
+
+    def add(self, stage, start, count=1):
+        """Adds the time since start, a perf_counter reading, to stage.
+        Returns that time."""
+        secs = time.perf_counter() - start
+        self.total(stage, secs, count)
+        return secs
+
+    def total(self, stage, secs, count=1):
+        """Adds secs to stage."""
+        total = self.stages.setdefault(stage, [0.0, 0])
+        total[0] += secs
+        total[1] += count
+
+    def section(self, seed, index, section_type, frag, secs, cached):
+        tex_bytes = len(frag["tex"].encode())
+        if frag["sheet"]:
+            tex_bytes += len(frag["sheet"].encode())
+        self.sections.append({"seed": str(seed), "index": index,
+                              "type": section_type,
+                              "questions": frag["count"],
+                              "tex_bytes": tex_bytes, "seconds": secs,
+                              "cached": cached})
+
+    def document(self, filename, **fields):
+        name = os.path.basename(filename)
+        self.documents.setdefault(name, {}).update(fields)
+
+    def to_dict(self):
+        info = latexify.cache_info()
+        start = self.latexify_start
+        stages = sorted(self.stages, key=lambda s: (
+            Metrics.stage_names.index(s) if s in Metrics.stage_names
+            else len(Metrics.stage_names), s))
+        return {"stages": [{"stage": s, "seconds": self.stages[s][0],
+                            "count": self.stages[s][1]} for s in stages],
+                "latexify": {"hits": info.hits - start.hits,
+                             "misses": info.misses - start.misses},
+                "sections": self.sections,
+                "documents": [dict(document=name, **fields) for name, fields
+                              in self.documents.items()]}
+
+    def table(self):
+        """Returns the metrics as human-readable tables."""
+        report = self.to_dict()
+        lines = ["{:<10} {:>7} {:>10}".format("stage", "count", "seconds")]
+        for s in report["stages"]:
+            lines.append("{:<10} {:>7} {:>10.4f}".format(
+                s["stage"], s["count"], s["seconds"]))
+        lines.append("")
+        lines.append("{:<12} {:>3} {:<6} {:>9} {:>9} {:>10}".format(
+            "seed", "#", "type", "questions", "tex bytes", "seconds"))
+        for s in report["sections"]:
+            lines.append("{:<12} {:>3} {:<6} {:>9} {:>9} {:>10.4f}  {}"
+                         .format(s["seed"][:12], s["index"], s["type"],
+                                 s["questions"], s["tex_bytes"],
+                                 s["seconds"], "cached" if s["cached"]
+                                 else "").rstrip())
+        lines.append("")
+        lines.append("{:<32} {:>9} {:>8} {:>10} {:>5}".format(
+            "document", "tex bytes", "written", "latexmk s", "runs"))
+        for d in report["documents"]:
+            latexmk = d.get("latexmk_seconds")
+            lines.append("{:<32} {:>9} {:>8} {:>10} {:>5}".format(
+                d["document"], d.get("tex_bytes", ""),
+                "yes" if d.get("written") else "no",
+                "" if latexmk is None else "{:.2f}".format(latexmk),
+                d.get("latexmk_runs", "")))
+        lines.append("")
+        lines.append("latexify cache: {} hits, {} misses".format(
+            report["latexify"]["hits"], report["latexify"]["misses"]))
+        return "\n".join(lines)
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format,
+        e.g. for node_exporter's textfile collector."""
+        report = self.to_dict()
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append("# HELP examtex_{} {}".format(name, help_text))
+            lines.append("# TYPE examtex_{} gauge".format(name))
+            for labels, value in samples:
+                labels = ",".join('{}="{}"'.format(k, str(v).replace(
+                    "\\", "\\\\").replace('"', '\\"'))
+                    for k, v in labels)
+                lines.append("examtex_{}{{{}}} {}".format(name, labels,
+                                                          value))
+
+        stages = report["stages"]
+        metric("stage_seconds", "Wall time spent in each build stage.",
+               [([("stage", s["stage"])], s["seconds"]) for s in stages])
+        metric("stage_count", "Times each build stage ran.",
+               [([("stage", s["stage"])], s["count"]) for s in stages])
+        sections = [([("seed", s["seed"]), ("section", s["index"]),
+                      ("type", s["type"])], s) for s in report["sections"]]
+        metric("section_seconds", "Time spent rendering each section.",
+               [(labels, s["seconds"]) for labels, s in sections])
+        metric("section_questions", "Questions in each section.",
+               [(labels, s["questions"]) for labels, s in sections])
+        metric("section_tex_bytes", "Bytes of tex rendered per section.",
+               [(labels, s["tex_bytes"]) for labels, s in sections])
+        documents = [([("document", d["document"])], d)
+                     for d in report["documents"]]
+        metric("document_tex_bytes", "Size of each tex file.",
+               [(labels, d["tex_bytes"]) for labels, d in documents
+                if "tex_bytes" in d])
+        metric("latexmk_seconds", "Time latexmk took for each document.",
+               [(labels, d["latexmk_seconds"]) for labels, d in documents
+                if "latexmk_seconds" in d])
+        metric("latexmk_runs", "LaTeX runs latexmk needed per document.",
+               [(labels, d["latexmk_runs"]) for labels, d in documents
+                if "latexmk_runs" in d])
+        metric("latexify_cache", "latexify cache lookups.",
+               [([("result", r)], report["latexify"][r])
+                for r in ["hits", "misses"]])
+        return "\n".join(lines) + "\n"
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument("--timings", action="store_true",
+                        help="print where the build spent its time")
+    parser.add_argument("--metrics-json", metavar="FILE",
+                        help="write build metrics to FILE as JSON")
+    parser.add_argument("--metrics-prom", metavar="FILE",
+                        help="write build metrics to FILE as a Prometheus "
+                        "textfile")
+
+
+class BuildState(threading.local):
+    """What the build running in a thread records: the Metrics being
+    collected, or None. Each thread has its own, so that concurrent
+    builds (e.g. the requests of a server) are measured apart."""
+    metrics = None
+
+
+def start_metrics(args):
+    """Starts measuring the build in this thread if any of the metrics
+    arguments were given."""
+    if args.timings or args.metrics_json or args.metrics_prom:
+        state.metrics = Metrics()
+    return state.metrics
+
+
+def report_metrics(args):
+    """Prints and writes the metrics asked for by args."""
+    if not state.metrics:
+        return
+    if args.timings:
+        print(state.metrics.table())
+    outputs = [(args.metrics_json,
+                lambda: json.dumps(state.metrics.to_dict(), indent=2) + "\n"),
+               (args.metrics_prom, state.metrics.prometheus)]
+    for path, text in outputs:
+        if path:
+            # replaced atomically, so collectors never read half a file
+            with open(path + ".tmp", 'w') as fileout:
+                fileout.write(text())
+            os.replace(path + ".tmp", path)
+
+
+def find_image(path):
+    """Returns the file \\includegraphics{path} would use, or None."""
+    for ext in ["", ".pdf", ".png", ".jpg", ".jpeg"]:
+        if os.path.isfile(path + ext):
+            return path + ext
+    return None
+
+
+def process_image(src, dst, max_width, max_height):
+    """Saves a copy of the image at src to dst, scaled down to fit in
+    max_width by max_height pixels (either may be None), turned upright
+    and without metadata. Runs in a worker process."""
+    from PIL import Image as PILImage
+    from PIL import ImageOps
+    tmp = tmp_path(dst)
+    with PILImage.open(src) as img:
+        img = ImageOps.exif_transpose(img)
+        scale = 1.0
+        if max_width:
+            scale = min(scale, max_width / img.width)
+        if max_height:
+            scale = min(scale, max_height / img.height)
+        if scale < 1:
+            size = (max(1, round(img.width * scale)),
+                    max(1, round(img.height * scale)))
+            img = img.resize(size, PILImage.LANCZOS)
+        if dst.endswith(".jpg"):
+            if img.mode not in ["RGB", "L", "CMYK"]:
+                img = img.convert("RGB")
+            img.save(tmp, "JPEG", quality=90, optimize=True)
+        else:
+            if img.mode not in ["RGB", "RGBA", "L", "LA", "P", "1"]:
+                img = img.convert("RGBA")
+            img.save(tmp, "PNG", optimize=True)
+    os.replace(tmp, dst)
+
+
+class ImageCache:
+    """Copies of the exam's images prepared for pdflatex: formats it cannot
+    include are converted to PNG, images are scaled down to the size they
+    are printed at, and metadata is stripped. Copies are named after a
+    hash of the image's contents and the size it is scaled to, so an image
+    is only processed again once either changes. Images are processed by
+    a pool of worker processes, started when first needed and stopped by
+    close. Each build has its own."""
+
+    # \\textwidth and \\textheight of template.tex, in inches
+    textwidth = 6.5
+    textheight = 9.0
+    units = {"in": 1.0, "cm": 1 / 2.54, "mm": 1 / 25.4, "pt": 1 / 72.27}
+    # formats that are converted, mapped to the format of their copies
+    formats = {".jpg": ".jpg", ".jpeg": ".jpg", ".png": ".png",
+               ".gif": ".png", ".bmp": ".png", ".tif": ".png",
+               ".tiff": ".png", ".webp": ".png"}
+
+    def __init__(self, basedir, dpi=300):
+        self.basedir = basedir
+        self.dpi = dpi
+        self.path = os.path.join(basedir, ".examtex-cache", "images")
+        self.pool = None
+        # copy path: (image path, pending job)
+        self.jobs = {}
+        # image file: (signature, content hash)
+        self.digests = {}
+        # (image path, width, height, copy path) of each image prepared
+        # since this list was last reset
+        self.prepared = []
+
+    def pixels(self, length, full):
+        """Returns the number of pixels length spans at self.dpi, where
+        full is the length of \\textwidth or \\textheight, or None if
+        length is not understood."""
+        match = re.match(r"\s*(\d*\.?\d*)\s*\\(textwidth|linewidth|textheight)"
+                         r"\s*$", length)
+        if match:
+            inches = float(match.group(1) or 1) * full
+        else:
+            match = re.match(r"\s*(\d*\.?\d+)\s*(in|cm|mm|pt)\s*$", length)
+            if not match:
+                return None
+            inches = float(match.group(1)) * ImageCache.units[match.group(2)]
+        return max(1, round(inches * self.dpi))
+
+    def digest(self, path):
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if self.digests.get(path, (None,))[0] != signature:
+            with open(path, 'rb') as filein:
+                digest = hashlib.sha256(filein.read()).hexdigest()
+            self.digests[path] = (signature, digest)
+        return self.digests[path][1]
+
+    def prepare(self, img_path, width=None, height=None):
+        """Returns the path to include instead of img_path, shown at the
+        given width or height (tex lengths), and queues the image to be
+        processed if its copy does not exist yet. Images that are missing
+        or not in a raster format are left as they are."""
+        found = find_image(os.path.join(self.basedir, img_path))
+        if found is None:
+            return img_path
+        ext = os.path.splitext(found)[1].lower()
+        if ext not in ImageCache.formats:
+            return img_path
+        max_width = width and self.pixels(width, ImageCache.textwidth)
+        max_height = height and self.pixels(height, ImageCache.textheight)
+        name = Cache.key(self.digest(found), max_width, max_height)
+        copy = os.path.join(self.path, name[:32] + ImageCache.formats[ext])
+        if copy not in self.jobs and not os.path.isfile(copy):
+            if self.pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                os.makedirs(self.path, exist_ok=True)
+                self.pool = ProcessPoolExecutor()
+            job = self.pool.submit(process_image, found, copy, max_width,
+                                   max_height)
+            self.jobs[copy] = (img_path, job)
+        copy = os.path.relpath(copy, self.basedir)
+        self.prepared.append([img_path, width, height, copy])
+        return copy
+
+    def check(self, prepared):
+        """Prepares the images a cached fragment included again. Returns
+        whether their copies still have the paths the fragment uses."""
+        return all(self.prepare(img_path, width, height) == copy
+                   for img_path, width, height, copy in prepared)
+
+    def finish(self):
+        """Waits for the queued images to be processed."""
+        for copy, (img_path, job) in self.jobs.items():
+            try:
+                job.result()
+            except Exception as e:
+                compile_error("Could not process image {}: {}".format(
+                    img_path, e))
+        self.jobs = {}
+
+    def close(self):
+        """Stops the worker processes, once the queued images are
+        processed."""
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def compile_tex(tex_file, builddir, builder=None, timeout=None,
+                jobname=None, aux_from=None, env=None):
+    """Runs latexmk on tex_file with its own output directory under
+    builddir (relative to the directory of tex_file), then moves the
+    finished pdf next to the tex file. The job is named after the file
+    unless jobname is given. If aux_from names a job compiled from the
+    same file, its aux file seeds this job's, which then needs no rerun
+    if their pages come out the same. The latexmk process is handed to
+    builder, if given, so that it can be cancelled, and killed after
+    timeout seconds, if given. latexmk runs in the environment env, if
+    given, instead of this process's. Returns (exit code, seconds,
+    latexmk output); the code is negative if the job was cancelled and
+    124 if it timed out."""
+    import signal
+    import subprocess
+    texdir, name = os.path.split(os.path.abspath(tex_file))
+    cmd = ["latexmk", "-pdf", "-quiet"]
+    if jobname:
+        cmd.append("-jobname=" + jobname)
+    jobname = jobname or name[:-4]
+    outdir = os.path.join(builddir, jobname)
+    cmd += ["-outdir=" + outdir, name]
+    if aux_from:
+        import shutil
+        aux = os.path.join(texdir, builddir, aux_from, aux_from + ".aux")
+        if os.path.isfile(aux):
+            os.makedirs(os.path.join(texdir, outdir), exist_ok=True)
+            shutil.copyfile(aux, os.path.join(texdir, outdir,
+                                              jobname + ".aux"))
+    start = time.time()
+    if builder is not None and builder.cancelled:
+        return -15, 0.0, ""
+    try:
+        # in its own session, so cancelling also stops pdflatex
+        proc = subprocess.Popen(cmd, cwd=texdir, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,
+                                universal_newlines=True,
+                                start_new_session=True, env=env)
+        if builder is not None:
+            builder.add(proc)
+        try:
+            log = proc.communicate(timeout=timeout)[0]
+            code = proc.returncode
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            log = proc.communicate()[0]
+            log += "\nTimed out after {} seconds.".format(timeout)
+            code = 124
+    except OSError as e:
+        code, log = 127, str(e)
+    pdf = os.path.join(texdir, outdir, jobname + ".pdf")
+    if code == 0 and os.path.isfile(pdf):
+        os.replace(pdf, os.path.join(texdir, jobname + ".pdf"))
+    return code, time.time() - start, log
+
+
+def write_file(filename, text):
+    """Writes text to filename, unless the file already holds exactly that
+    text. Leaving unchanged files alone keeps their mtimes, so latexmk
+    does not rebuild them."""
+    if state.metrics:
+        start = time.perf_counter()
+    changed = True
+    try:
+        with open(filename, 'r') as filein:
+            changed = filein.read() != text
+    except OSError:
+        pass
+    if changed:
+        with open(filename, 'w+') as fileout:
+            fileout.write(text)
+    if state.metrics:
+        state.metrics.add("write", start)
+        state.metrics.document(filename, tex_bytes=len(text.encode()),
+                               written=changed)
+
+
+class Sink:
+    """A tex document written piece by piece as the sections are rendered,
+    so that only one section's tex is held in memory at a time. part names
+    the fragment field it is made of: "tex" for the exam itself, "sheet"
+    for the answer sheet. answers turns on \\printanswers. Without header,
+    pages get no header or page number (see SplitSink). output is a
+    filename or a text stream. A file is written to a temporary file
+    first, which only replaces it once it is complete, and only if its
+    contents changed."""
+
+    def __init__(self, output, part="tex", answers=False, header=True):
+        self.stream = None
+        self.filename = output
+        if not isinstance(output, str):
+            self.stream = output
+            self.filename = None
+        self.part = part
+        self.answers = answers
+        self.header = header
+        self.tmp = self.filename and tmp_path(self.filename)
+        self.fileout = None
+
+    def write(self, tex):
+        if state.metrics:
+            start = time.perf_counter()
+        if self.fileout is None:
+            self.fileout = self.stream or open(self.tmp, 'w')
+        else:
+            tex = "\n" + tex
+        self.fileout.write(tex)
+        if state.metrics:
+            state.metrics.add("write", start, 0)
+
+    def begin(self, exam):
+        self.write(exam.meta_tex(self.answers, self.header))
+        if not self.header:
+            self.write("\\pagestyle{empty}")
+        self.write("\n\\begin{document}")
+        if self.part == "sheet":
+            self.write("\\section*{Answer Sheet}")
+
+    def add(self, frag):
+        tex = frag[self.part]
+        self.write(tex)
+        if self.part == "sheet" and tex != "":
+            self.write("\\vspace{0.25in}")
+
+    def close(self):
+        import filecmp
+        self.write("\\end{document}\n")
+        if self.stream is not None:
+            return
+        if state.metrics:
+            start = time.perf_counter()
+        self.fileout.close()
+        size = os.path.getsize(self.tmp)
+        changed = not (os.path.isfile(self.filename)
+                       and filecmp.cmp(self.tmp, self.filename,
+                                       shallow=False))
+        if changed:
+            os.replace(self.tmp, self.filename)
+        else:
+            os.remove(self.tmp)
+        if state.metrics:
+            state.metrics.add("write", start)
+            state.metrics.document(self.filename, tex_bytes=size,
+                                   written=changed)
+
+    def discard(self):
+        """Removes the temporary file of a document left unfinished."""
+        if self.stream is not None:
+            return
+        if self.fileout is not None:
+            self.fileout.close()
+        if os.path.isfile(self.tmp):
+            os.remove(self.tmp)
+
+
+class SplitSink:
+    """A tex document compiled in parts, with the interface of Sink. The
+    sections from each position in starts up to the next go into a
+    document of their own without the page header (see chunk_files), and
+    output becomes a document that includes their pdfs with pdfpages, on
+    pages styled and numbered by it. The parts can be compiled in
+    parallel, since every section but a cover starts a new page and sets
+    its own question numbers. If answers is a job name (see
+    answers_tex), each part prints answers under its own key_jobname,
+    and the document includes the parts compiled under its job name."""
+
+    def __init__(self, output, starts, part="tex", answers=False):
+        self.output = output
+        self.starts = starts
+        self.part = part
+        self.answers = answers
+        self.files = chunk_files(output, len(starts))
+        self.sink = None
+        self.exam = None
+        self.count = 0
+
+    def begin(self, exam):
+        self.exam = exam
+
+    def add(self, frag):
+        if self.count in self.starts:
+            if self.sink:
+                self.sink.close()
+            name = self.files[self.starts.index(self.count)]
+            answers = self.answers
+            if not isinstance(answers, bool):
+                answers = key_jobname(name)
+            self.sink = Sink(name, self.part, answers, header=False)
+            self.sink.begin(self.exam)
+        self.sink.add(frag)
+        self.count += 1
+
+    def close(self):
+        self.sink.close()
+        # an empty pagecommand leaves the pages in the document's own
+        # style, so the header and page numbers run on across the parts
+        tex = [self.exam.meta_tex(), "\\usepackage{pdfpages}",
+               "\n\\begin{document}"]
+        for k, name in enumerate(self.files):
+            name = os.path.basename(name)[:-4]
+            if not isinstance(self.answers, bool):
+                name = "\\jobname-{}".format(k + 1)
+            tex.append("\\includepdf[pages=-,pagecommand={{}}]{{{}.pdf}}"
+                       .format(name))
+        tex.append("\\end{document}\n")
+        write_file(self.output, "\n".join(tex))
+
+    def discard(self):
+        if self.sink:
+            self.sink.discard()
 
-class Exam:
 
-    def __init__(self, examdata):
+def chunk_files(filename, count):
+    """Returns the names of the count parts of the tex file filename
+    compiled in parts: NAME-1.tex, NAME-2.tex, ..."""
+    return ["{}-{}.tex".format(filename[:-4], k + 1) for k in range(count)]
+
+
+def render_section(section, start, answer_sheet):
+    """Renders a shuffled section whose questions are numbered from
+    start + 1. Rendering has no side effects, so sections can be
+    rendered concurrently. Returns the section's fragment (see
+    Exam.render) and the seconds rendering took."""
+    clock = time.perf_counter()
+    frag = {"tex": section.to_tex(start, answer_sheet), "sheet": None,
+            "count": section.count(),
+            "answers": section.answers(),
+            "points": section.points(),
+            "images": section.images()}
+    if answer_sheet:
+        frag["sheet"] = section.ans_sheet_tex(start)
+    return frag, time.perf_counter() - clock
+
+
+class Exam:
+    section_types = {"cover": Cover, "match": Match, "tf": TF, "mc": MC,
+                     "frq": FRQ}
+    # bump whenever the data of any node changes
+    ast_version = 2
+    header_ptrn = re.compile(r"(?i)\s*\[(meta|cover|match|tf|mc|frq)\]\s*$")
+
+    def __init__(self, lines, lazy=False, basedir="", template=None,
+                 asts=None, errors=None):
+        """Parses an exam from the lines of an .exam file, whose paths are
+        relative to basedir, to be rendered with template (by default
+        template.tex). If lazy, each section is only parsed once it is
+        needed for rendering. asts maps section hashes to the data of
+        sections parsed before (see to_data), which are loaded instead of
+        parsed again, wherever in the file the sections now start. If
+        errors is a list, the errors parsing can get past are collected in
+        it instead of raised (see check_exam)."""
+        self.template = load_template() if template is None else template
+        self.asts = asts or {}
+        # whether any section was parsed rather than loaded
+        self.reparsed = False
         self.sections = []
+        self.spans = []
         self.meta = {}
-        sec_pattern = r"(?i)\s*\[(meta|cover|match|tf|mc|frq)\]\s*$"
-        section_inds = [re.match(sec_pattern, line) for line in examdata]
-        section_inds = np.flatnonzero(section_inds)
+        # the line of the (last) meta section header
+        self.meta_lineno = None
+        self.images = []
+        self.banks = []
+        # whether documents use a format precompiled from the preamble
+        self.precompiled = False
+        # the ImageCache preparing copies of the images, if any
+        self.image_cache = None
+        # the tex files written by transpile
+        self.written = []
+        # the parts of the tex files written in parts (see SplitSink)
+        self.chunks = {}
+        # the other jobs each tex file is compiled as (see key_jobname)
+        self.jobnames = {}
+        if state.metrics:
+            clock = time.perf_counter()
+        source = Source(lines, basedir, errors=errors)
+        self.source = source
+        examdata = source.lines
+        # most lines cannot be headers, and testing for "[" is far
+        # cheaper than matching the pattern on every line of large exams
+        section_inds = [i for i, line in enumerate(examdata)
+                        if "[" in line and Exam.header_ptrn.match(line)]
         if len(section_inds) == 0:
             compile_error("No sections found.")
-        section_inds = list(section_inds)
         section_inds.append(len(examdata))
+        import bisect
+        linenos = source.linenos
+        gaps = source.gaps
         for i in range(len(section_inds)-1):
             ind = section_inds[i]
             section_type = examdata[ind].strip()[1:-1].lower()
             start = ind + 1
             end = section_inds[i+1]
             if start >= end:
-                compile_error("Empty section found.", examdata[ind])
-            content = examdata[start:end]
+                source.report(ExamError("Empty section found.",
+                                        examdata[ind], source.linenos[ind]))
+                continue
             if section_type == "meta":
-                meta = process_options(content)
+                meta = process_options(Cursor(source, start, end))
                 self.meta.update(meta)
-            elif section_type == "cover":
-                self.sections.append(Cover(content))
-            elif section_type == "match":
-                self.sections.append(Match(content))
-            elif section_type == "tf":
-                self.sections.append(TF(content))
-            elif section_type == "mc":
-                self.sections.append(MC(content))
-            elif section_type == "frq":
-                self.sections.append(FRQ(content))
+                self.meta_lineno = source.linenos[ind]
+            else:
+                text = "".join(examdata[ind:end])
+                # blank lines are left out of the text, but move the lines
+                # after them, which the data counts from the header
+                text += repr([(j - ind, linenos[j] - linenos[j-1]) for j in
+                              gaps[bisect.bisect(gaps, ind):
+                                   bisect.bisect_left(gaps, end)]])
+                try:
+                    text += self.pool_signature(start, end)
+                except ExamError as e:
+                    source.report(e)
+                digest = hashlib.sha256(text.encode()).hexdigest()
+                self.spans.append((section_type, start, end, digest))
         self.format_meta()
+        self.sections = [None] * len(self.spans)
+        if state.metrics:
+            state.metrics.add("scan", clock)
+        if not lazy:
+            for i in range(len(self.spans)):
+                self.section(i)
+
+    def pool_signature(self, start, end):
+        """Returns the paths and signatures of the question banks the
+        section in [start, end) draws from, so that its cache key changes
+        along with them. Their paths are collected in self.banks."""
+        lines = self.source.lines[start:end]
+        sep = [i for i, line in enumerate(lines) if line.startswith("-----")]
+        signature = ""
+        for line in lines[:sep[0] if sep else 0]:
+            match = re.match(r"(?i)\s*pool\s*::(.*)", line)
+            if match:
+                for path in match.group(1).split(";;"):
+                    path = os.path.join(self.source.basedir, path.strip())
+                    signature += repr((path, Bank.stat(path)))
+                    if path not in self.banks:
+                        self.banks.append(path)
+        return signature
+
+    def section(self, i):
+        """Returns the i-th section, parsing it if needed."""
+        if self.sections[i] is None:
+            if state.metrics:
+                clock = time.perf_counter()
+            section_type, start, end, digest = self.spans[i]
+            if digest in self.asts:
+                with PausedGC():
+                    self.sections[i] = node_from_data(
+                        self.asts[digest], self.source.basedir,
+                        self.source.linenos[start - 1])
+            else:
+                cur = Cursor(self.source, start, end)
+                self.sections[i] = Exam.section_types[section_type](cur)
+                self.reparsed = True
+            if state.metrics:
+                state.metrics.add("parse", clock)
+        return self.sections[i]
+
+    def shuffle(self, i, seed, shuffle_questions=False):
+        """Returns the i-th section, shuffled for seed."""
+        section = self.section(i)
+        rng = random.Random("{}-{}".format(seed, i))
+        section.shuffle(rng, shuffle_questions)
+        return section
+
+    def to_data(self, absolute=False):
+        """Returns the exam as dicts, lists, strings and numbers, for
+        save_ast: its meta section, and each section's type, source hash
+        and data (see Section.to_data) in its current order, or None if it
+        was neither parsed nor loaded. Line numbers are counted from each
+        section's header, so that the data still holds once lines are
+        added above it, unless absolute."""
+        sections = []
+        for i, (section_type, start, _, digest) in enumerate(self.spans):
+            base = 0 if absolute else self.source.linenos[start - 1]
+            if self.sections[i] is not None:
+                data = self.sections[i].to_data(base)
+            elif absolute and digest in self.asts:
+                data = self.section(i).to_data(base)
+            else:
+                data = self.asts.get(digest)
+            sections.append([section_type, digest, data])
+        return {"format": "examtex-ast", "version": Exam.ast_version,
+                "meta": self.meta, "sections": sections}
 
     def format_meta(self):
         meta = self.meta
         if "answer sheet" in meta:
             sheet = meta["answer sheet"][0].lower()
             if sheet not in ["true", "false"]:
-                compile_error("Answer sheet option must be boolean.")
+                self.source.report(ExamError(
+                    "Answer sheet option must be boolean.",
+                    lineno=self.meta_lineno))
             meta["answer sheet"] = (sheet == "true")
         else:
             meta["answer sheet"] = False
@@ -689,45 +2648,231 @@ class Exam:
             meta["image sheet"] = meta["image sheet"][0]
         else:
             meta["image sheet"] = None
-
-    def meta_tex(self):
-        tex = [template]
+        if "header" in meta and len(meta["header"]) != 3:
+            self.source.report(ExamError("Header must have three parts.",
+                                         ";; ".join(meta["header"]),
+                                         self.meta_lineno))
+
+    def documents(self):
+        """Returns the names of the documents of each version."""
+        names = ["EXAM", "KEY"]
+        if self.meta["answer sheet"]:
+            names.append("ANS_SHEET")
+        return names
+
+    def part(self, name):
+        """Returns the fragment field the document name is made of (see
+        Sink)."""
+        if name == "ANS_SHEET" or (name == "KEY" and
+                                   self.meta["answer sheet"]):
+            # the key of an exam with an answer sheet is the answer sheet
+            # with answers
+            return "sheet"
+        return "tex"
+
+    def split_points(self, chunks):
+        """Returns the positions of the sections starting each of at most
+        chunks runs of consecutive sections, such that the longest run
+        (in lines) is as short as can be. A Cover section never starts a
+        run, since it does not start a new page."""
+        sizes = [end - start for _, start, end, _ in self.spans]
+
+        def runs(most):
+            # the runs of at most most lines, each as long as it can be
+            points = [0]
+            length = 0
+            for i, size in enumerate(sizes):
+                if length + size > most and length > 0 and \
+                        self.spans[i][0] != "cover":
+                    points.append(i)
+                    length = 0
+                length += size
+            return points
+
+        low, high = max(sizes), sum(sizes)
+        while low < high:
+            middle = (low + high) // 2
+            if len(runs(middle)) <= chunks:
+                high = middle
+            else:
+                low = middle + 1
+        return runs(low)
+
+    def render(self, seed, shuffle_questions=False, cache=None, pool=None):
+        """Shuffles every section for seed and renders it. Yields one
+        fragment per section, in order: a dict holding its tex, its answer
+        sheet tex (or None), its number of questions and their answers.
+
+        Numbering is settled first: each section is taken from cache (if
+        the section, meta, template, seed and starting question number are
+        all unchanged) or shuffled, and starts where the sections before it
+        end. The sections left are then rendered by render_section, on
+        pool (a concurrent.futures executor) if given. Paths of the
+        included images are collected in self.images."""
+        answer_sheet = self.meta["answer sheet"]
+        image_cache = self.image_cache
+        plan = []
+        start = 0
+        for i, (section_type, _, _, digest) in enumerate(self.spans):
+            if state.metrics:
+                clock = time.perf_counter()
+            frag = None
+            key = None
+            if cache:
+                key = self.cache_key(i, seed, shuffle_questions, start)
+                frag = cache.get(key)
+            if image_cache:
+                image_cache.prepared = []
+            if frag and image_cache and not image_cache.check(
+                    frag["prepared"]):
+                # an image changed, so its prepared copy has a new path
+                frag = None
+            section = None
+            if frag is None:
+                self.section(i)
+                if state.metrics:
+                    # parsing is timed separately
+                    clock = time.perf_counter()
+                section = self.shuffle(i, seed, shuffle_questions)
+                count = section.count()
+                if image_cache:
+                    image_cache.prepared = []
+                    for img in section.image_modules():
+                        img.copy = image_cache.prepare(
+                            img.img_path, width=img.options["width"])
+            else:
+                count = frag["count"]
+            secs = time.perf_counter() - clock if state.metrics else 0
+            # the images this section prepared, and no later ones
+            prepared = image_cache and list(image_cache.prepared)
+            plan.append((section_type, start, key, frag, section, secs,
+                         prepared))
+            start += count
+
+        jobs = [None] * len(plan)
+        if pool:
+            for i, (_, start, _, frag, section, _, _) in enumerate(plan):
+                if frag is None:
+                    jobs[i] = pool.submit(render_section, section, start,
+                                          answer_sheet)
+        for i, (section_type, start, key, frag, section, secs, prepared) in \
+                enumerate(plan):
+            cached = frag is not None
+            if jobs[i]:
+                frag, elapsed = jobs[i].result()
+            elif not cached:
+                frag, elapsed = render_section(section, start, answer_sheet)
+            if not cached:
+                frag["type"] = section_type
+                if image_cache:
+                    frag["prepared"] = prepared
+                secs += elapsed
+                if cache:
+                    cache.put(key, frag)
+            if state.metrics:
+                state.metrics.total("render", secs)
+                state.metrics.section(seed, i, section_type, frag, secs,
+                                      cached)
+            for img in frag["images"]:
+                if img not in self.images:
+                    self.images.append(img)
+            yield frag
+
+    def cache_key(self, i, seed, shuffle_questions, start):
+        """Returns the key of the i-th section's fragment in a Cache, when
+        shuffled for seed and numbered from start + 1."""
+        image_cache = self.image_cache
+        return Cache.key(self.spans[i][3], repr(sorted(self.meta.items())),
+                         self.template, seed, i, shuffle_questions, start,
+                         image_cache and image_cache.dpi)
+
+    def numbering(self, seed, shuffle_questions=False, cache=None):
+        """Returns the number of questions before each section and in it
+        when shuffled for seed, as render numbers them. The counts of
+        sections found in cache are taken from there."""
+        starts = []
+        counts = []
+        start = 0
+        for i in range(len(self.spans)):
+            frag = cache and cache.get(self.cache_key(i, seed,
+                                                      shuffle_questions,
+                                                      start))
+            if frag:
+                count = frag["count"]
+            else:
+                count = self.shuffle(i, seed, shuffle_questions).count()
+            starts.append(start)
+            counts.append(count)
+            start += count
+        return starts, counts
+
+    def find_sections(self, names):
+        """Returns the positions of the sections given by names, in order:
+        by their position counting from 1 (meta sections aside), or by
+        their Name option, ignoring case."""
+        found = set()
+        for name in names:
+            if name.isdigit() and 1 <= int(name) <= len(self.spans):
+                found.add(int(name) - 1)
+                continue
+            matches = [i for i in range(len(self.spans))
+                       if (self.section(i).options["name"] or "").lower()
+                       == name.strip().lower()]
+            if not matches:
+                compile_error("No section {} in the exam.".format(name))
+            found.update(matches)
+        return sorted(found)
+
+    def preamble(self, answers=False):
+        """Returns the part of the preamble every document shares: the
+        template and the packages, with \\printanswers turned on if
+        answers (see answers_tex)."""
+        tex = [self.template]
+        if answers:
+            tex = [self.template.replace("%\\printanswers",
+                                         answers_tex(answers))]
         if "packages" in self.meta:
             for pkg in self.meta["packages"]:
                 tex.append("\\usepackage{{{}}}\n".format(pkg))
-        if "header" in self.meta:
-            header = self.meta["header"]
-            if len(header) != 3:
-                compile_error("Header must have three parts.", header)
-            l, c, r = map(latexify, header)
+        return "\n".join(tex)
+
+    def format_name(self):
+        """Returns the name of the format precompiled from the shared
+        preamble, which changes along with it."""
+        digest = hashlib.sha256(self.preamble().encode()).hexdigest()
+        return "examtex-" + digest[:16]
+
+    def format_tex(self):
+        """Returns the source mylatexformat dumps the format from."""
+        return "\n".join([self.preamble(), "\\csname endofdump\\endcsname",
+                          "\\begin{document}", "\\end{document}\n"])
+
+    def meta_tex(self, answers=False, header=True):
+        """Returns the preamble, with \\printanswers turned on if
+        answers (see answers_tex), and the page header unless header is
+        False. If precompiled, the document asks for the format dumped
+        from the shared preamble on its first line, and pdflatex skips
+        straight to \\endofdump; \\printanswers is set after it, so
+        that the exam and its key share one format."""
+        if self.precompiled:
+            tex = ["%&" + self.format_name(), self.preamble(),
+                   "\\csname endofdump\\endcsname"]
+            if answers:
+                tex.append(answers_tex(answers))
+        else:
+            tex = [self.preamble(answers)]
+        if header and "header" in self.meta:
+            l, c, r = map(latexify, self.meta["header"])
             c = c + (" - Page \\thepage" if c != "" else "")
             r = r + (":\\kern .5 in" if r != "" else "")
             header_tex = "\\header{{{}}}{{{}}}{{{}}}\n".format(l, c, r)
             tex.append("\\pagestyle{head}\n" + header_tex + "\\headrule")
         return "\n".join(tex)
 
-    def to_tex(self):
-        tex = [self.meta_tex()]
-        tex.append("\n\\begin{document}")
-        for section in self.sections:
-            tex.append(section.to_tex())
-        tex.append("\\end{document}\n")
-        return "\n".join(tex)
-
-    def ans_sheet_tex(self):
-        tex = [self.meta_tex()]
-        tex.append("\n\\begin{document}")
-        tex.append("\\section*{Answer Sheet}")
-        for section in self.sections:
-            ans = section.ans_sheet_tex()
-            tex.append(ans)
-            if ans != "":
-                tex.append("\\vspace{0.25in}")
-        tex.append("\\end{document}\n")
-        return "\n".join(tex)
-
     def image_sheet_tex(self):
         fp = self.meta["image sheet"]
+        if self.image_cache:
+            fp = self.image_cache.prepare(fp, height=".96\\textheight")
         tex = [self.meta_tex()]
         tex.append("\n\\begin{document}")
         tex.append("\\section*{Image Sheet}")
@@ -736,48 +2881,667 @@ class Exam:
         tex.append("\\end{document}\n")
         return "\n".join(tex)
 
-
-def main():
-    global exam
-    global qcount
-    global template
-    template_dir = os.path.join(os.path.dirname(sys.argv[0]), "template.tex")
-    with open(template_dir, 'r') as filein:
-        template = "".join(filein.readlines())
-    # existence of argument is checked in executable script
-    filename = sys.argv[1]
+    def html_page(self, body, title=""):
+        """Returns an HTML page of body, the sections' HTML, with the page
+        header and the style of the tex documents, and the scripts KaTeX
+        renders its math with in the browser."""
+        html = ["<!DOCTYPE html>", '<html lang="en">', "<head>",
+                '<meta charset="utf-8">',
+                "<title>{}</title>".format(htmlify(title)),
+                '<link rel="stylesheet" href="{}katex.min.css">'
+                .format(katex_url),
+                '<script defer src="{}katex.min.js"></script>'
+                .format(katex_url),
+                '<script defer src="{}contrib/auto-render.min.js"></script>'
+                .format(katex_url),
+                "<script>{}</script>".format(katex_script),
+                "<style>{}</style>".format(html_style), "</head>", "<body>"]
+        if "header" in self.meta:
+            l, c, r = map(htmlify, self.meta["header"])
+            if r != "":
+                r += ': <span class="line"></span>'
+            html.append("<header><span>{}</span><span>{}</span><span>{}"
+                        "</span></header>".format(l, c, r))
+        html.append(body)
+        html.append("</body>\n</html>\n")
+        return "\n".join(html)
+
+    def image_sheet_html(self):
+        src = image_src(self.source.basedir, self.meta["image sheet"])
+        return self.html_page(
+            '<section><h2>Image Sheet</h2>\n<div class="image"><img src="{}" '
+            'alt=""></div>\n</section>'.format(html_attr(src)))
+
+
+def strip_answers(html):
+    """Returns the HTML of sections without their answers. Text from the
+    exam is escaped, so it never holds the answer markup, and answers
+    hold no spans."""
+    pieces = html.split('<span class="answer">')
+    for i in range(1, len(pieces)):
+        pieces[i] = pieces[i][pieces[i].index("</span>"):]
+    html = '<span class="answer">'.join(pieces)
+    return html.replace('<li class="correct">', "<li>")
+
+
+def image_src(basedir, img_path):
+    """Returns img_path, relative to basedir, with the file extension
+    LaTeX would pick (see find_image) if it has none."""
+    path = os.path.join(basedir, img_path)
+    return img_path + (find_image(path) or path)[len(path):]
+
+
+def answers_tex(answers):
+    """Returns the tex turning on \\printanswers: always if answers is
+    True, or else only in the job named answers, so that one tex file
+    can be compiled as both the exam and its key."""
+    if answers is True:
+        return "\\printanswers"
+    return ("\\edef\\examtexjob{{\\jobname}}"
+            "\\edef\\examtexkey{{\\detokenize{{{}}}}}"
+            "\\ifx\\examtexjob\\examtexkey\\printanswers\\fi"
+            .format(answers))
+
+
+def key_jobname(tex_file):
+    """Returns the job name the key is compiled under from tex_file, an
+    exam (or a part of one) written to be compiled as both: its name
+    with the last -EXAM turned into -KEY."""
+    name = os.path.basename(tex_file)[:-4]
+    head, _, tail = name.rpartition("-EXAM")
+    return head + "-KEY" + tail
+
+
+def write_version(exam, outputs, seed, shuffle_questions=False, cache=None,
+                  pool=None, split=None, single_source=False):
+    """Renders the exam for seed and writes its documents, streaming each
+    section into all of them as it is rendered. outputs maps each name in
+    exam.documents() to a filename or a text stream. If split lists the
+    positions of the sections starting each part (see
+    Exam.split_points), the exam and its key are written in parts to be
+    compiled in parallel (see SplitSink). If single_source and the key
+    only differs from the exam by its answers, the key is not written,
+    but compiled from the exam's file under key_jobname. Returns the
+    answer key: (question number, section type, answer letter or None,
+    points or None) for every question."""
+    single_source = single_source and exam.part("KEY") == "tex"
+    sinks = []
+    for name in exam.documents():
+        part = exam.part(name)
+        answers = name == "KEY"
+        if single_source:
+            if name == "KEY":
+                continue
+            if name == "EXAM":
+                answers = key_jobname(outputs[name])
+        if split and part == "tex":
+            sinks.append(SplitSink(outputs[name], split, part, answers))
+        else:
+            sinks.append(Sink(outputs[name], part, answers))
+    key = []
+    try:
+        for sink in sinks:
+            sink.begin(exam)
+        for frag in exam.render(seed, shuffle_questions, cache, pool):
+            for sink in sinks:
+                sink.add(frag)
+            for answer, points in zip(frag["answers"], frag["points"]):
+                key.append((len(key) + 1, frag["type"], answer, points))
+        for sink in sinks:
+            sink.close()
+    finally:
+        for sink in sinks:
+            sink.discard()
+    return key
+
+
+def write_preview(exam, output, seed, only=None, questions=None,
+                  shuffle_questions=False, cache=None):
+    """Writes a preview of part of the exam, shuffled for seed, to output
+    (a filename or a text stream): the sections given by only (see
+    Exam.find_sections), or every section, and of those just the
+    questions numbered first to last if questions is (first, last). The
+    modules before each question come along with it. Questions keep
+    their numbers in the whole exam, and answers are shown. Returns the
+    numbers of the questions previewed."""
+    starts, counts = exam.numbering(seed, shuffle_questions, cache)
+    selected = range(len(exam.spans))
+    if only:
+        selected = exam.find_sections(only)
+    sink = Sink(output, answers=True)
+    numbers = []
+    try:
+        sink.begin(exam)
+        for i in selected:
+            start = starts[i]
+            lo, hi = 0, counts[i]
+            if questions:
+                first, last = questions
+                lo = max(first - start - 1, 0)
+                hi = min(last - start, counts[i])
+                if lo >= hi:
+                    continue
+            section = exam.shuffle(i, seed, shuffle_questions)
+            content = section.content
+            if questions:
+                positions = [k for k, cont in enumerate(content)
+                             if section.is_question(cont)]
+                begin = positions[lo - 1] + 1 if lo > 0 else 0
+                section.content = content[begin:positions[hi - 1] + 1]
+            if exam.image_cache:
+                for img in section.image_modules():
+                    img.copy = exam.image_cache.prepare(
+                        img.img_path, width=img.options["width"])
+            frag, _ = render_section(section, start + lo, False)
+            # the rest of the section is still needed for to_data
+            section.content = content
+            sink.add(frag)
+            for img in frag["images"]:
+                if img not in exam.images:
+                    exam.images.append(img)
+            numbers += range(start + lo + 1, start + hi + 1)
+        if questions and not numbers:
+            compile_error("No questions numbered {} to {} in the exam."
+                          .format(*questions))
+        sink.close()
+    finally:
+        sink.discard()
+    return numbers
+
+
+def question_range(text):
+    """Returns the (first, last) question numbers of a range written
+    FIRST-LAST, or a single number."""
+    match = re.match(r"\s*(\d+)\s*(?:-\s*(\d+)\s*)?$", text)
+    if not match or int(match.group(2) or match.group(1)) < \
+            int(match.group(1)):
+        compile_error("Question range must look like 40-55.", text)
+    return int(match.group(1)), int(match.group(2) or match.group(1))
+
+
+def render_version(exam, seed, shuffle_questions=False, cache=None,
+                   pool=None):
+    """Renders the exam for seed into strings. Returns {document name:
+    tex} and the answer key (see write_version)."""
+    outputs = {name: io.StringIO() for name in exam.documents()}
+    key = write_version(exam, outputs, seed, shuffle_questions, cache, pool)
+    return {name: out.getvalue() for name, out in outputs.items()}, key
+
+
+def render_html(exam, seed, shuffle_questions=False, title=""):
+    """Renders the exam for seed into HTML pages, without LaTeX: the
+    sections' to_html, and the math left to KaTeX. Only keys show answers.
+    Returns {document name: html} and the answer key (see
+    write_version)."""
+    answer_sheet = exam.meta["answer sheet"]
+    parts = {"tex": [], "sheet": ["<section>", "<h2>Answer Sheet</h2>"]}
+    key = []
+    start = 0
+    for i, (section_type, _, _, _) in enumerate(exam.spans):
+        section = exam.shuffle(i, seed, shuffle_questions)
+        parts["tex"].append(section.to_html(start, answer_sheet))
+        if answer_sheet:
+            parts["sheet"].append(section.ans_sheet_html(start))
+        for answer, points in zip(section.answers(), section.points()):
+            key.append((len(key) + 1, section_type, answer, points))
+        start += section.count()
+    parts["sheet"].append("</section>")
+    pages = {}
+    for name in exam.documents():
+        body = "\n".join(frag for frag in parts[exam.part(name)] if frag)
+        if name != "KEY":
+            body = strip_answers(body)
+        pages[name] = exam.html_page(body, "{}-{}".format(title, name))
+    return pages, key
+
+
+def write_html_versions(exam, filename, seed, versions,
+                        shuffle_questions=False):
+    """Writes versions of the exam to HTML pages with the filename prefix,
+    as write_versions does to tex files, and the image sheet if there
+    is one. Returns the names of the pages written and (version, key)
+    for each version."""
+    keys = []
+    written = []
+    for version, version_seed in version_seeds(seed, versions):
+        prefix = "{}-{}".format(filename, version) if version else filename
+        pages, key = render_html(exam, version_seed, shuffle_questions,
+                                 os.path.basename(prefix))
+        for name, page in pages.items():
+            write_file("{}-{}.html".format(prefix, name), page)
+            written.append("{}-{}.html".format(prefix, name))
+        keys.append((version, key))
+    if exam.meta["image sheet"]:
+        write_file(filename+"-IMG_SHEET.html", exam.image_sheet_html())
+        written.append(filename+"-IMG_SHEET.html")
+    return written, keys
+
+
+def write_versions(exam, filename, seed, versions, shuffle_questions=False,
+                   cache=None, pool=None, split=None, single_source=False):
+    """Writes versions A, B, ... of the exam to tex files with the
+    filename prefix, each shuffled with its own seed, plus a VERSIONS.csv
+    table mapping question numbers to each version's answers. A single
+    version is written without a version letter. Documents written in
+    parts (see write_version) are listed in exam.chunks, along with their
+    parts, and files to be compiled as the key as well in exam.jobnames,
+    along with the job names. Returns the names of the tex files
+    written, parts first, and (version, key) for each version."""
+    keys = []
+    written = []
+    for version, version_seed in version_seeds(seed, versions):
+        prefix = "{}-{}".format(filename, version) if version else filename
+        outputs = {name: "{}-{}.tex".format(prefix, name)
+                   for name in exam.documents()}
+        key = write_version(exam, outputs, version_seed, shuffle_questions,
+                            cache, pool, split, single_source)
+        single = single_source and exam.part("KEY") == "tex"
+        for name, output in outputs.items():
+            if single and name == "KEY":
+                continue
+            if split and exam.part(name) == "tex":
+                exam.chunks[output] = chunk_files(output, len(split))
+                written += exam.chunks[output]
+            written.append(output)
+            if single and name == "EXAM":
+                for tex_file in exam.chunks.get(output, []) + [output]:
+                    exam.jobnames[tex_file] = [key_jobname(tex_file)]
+        keys.append((version, key))
+    if versions == 1:
+        return written, keys
+    answers = [{num: a for num, _, a, _ in key if a is not None}
+               for _, key in keys]
+    names = [version for version, _ in keys]
+    table = [",".join(["question"] + names)]
+    for num in sorted(answers[0]):
+        table.append(",".join([str(num)] + [key[num] for key in answers]))
+    write_file(filename+"-VERSIONS.csv", "\n".join(table) + "\n")
+    return written, keys
+
+
+def version_seeds(seed, versions):
+    """Returns the letter and seed of each version: A, B, ... with the
+    letter appended to seed, or a blank letter and seed itself for a
+    single version."""
+    if versions == 1:
+        return [("", seed)]
+    return [(chr(65 + i), "{}-{}".format(seed, chr(65 + i)))
+            for i in range(versions)]
+
+
+def export_ast(exam, seed, versions, shuffle_questions=False):
+    """Returns the exam's data (see Exam.to_data) with the sections of
+    every version, shuffled as they were rendered, under "versions". Line
+    numbers are those of the file."""
+    data = exam.to_data(absolute=True)
+    data["versions"] = []
+    for version, version_seed in version_seeds(seed, versions):
+        for i in range(len(exam.spans)):
+            exam.shuffle(i, version_seed, shuffle_questions)
+        data["versions"].append({
+            "version": version, "seed": str(version_seed),
+            "sections": [s[2] for s in
+                         exam.to_data(absolute=True)["sections"]]})
+    del data["sections"]
+    return data
+
+
+def key_csv(keys):
+    """Returns the answer keys of every version as CSV, one row per
+    question: its version (blank for a single version), number, section
+    type, answer letter (blank for FRQs) and points (blank if not
+    given)."""
+    table = ["version,question,type,answer,points"]
+    for version, key in keys:
+        for num, section_type, answer, points in key:
+            table.append("{},{},{},{},{}".format(
+                version, num, section_type, answer or "",
+                "" if points is None else "{:g}".format(points)))
+    return "\n".join(table) + "\n"
+
+
+def load_template(path=None):
+    """Returns the contents of template.tex, or of the template at path,
+    reading it again only once it changes."""
+    path = path or template_path
+    mtime = os.stat(path).st_mtime
+    with shared_lock:
+        if templates.get(path, (None,))[0] != mtime:
+            with open(path, 'r') as filein:
+                templates[path] = (mtime, "".join(filein.readlines()))
+        return templates[path][1]
+
+
+def parse(source, basedir="", lazy=False, template=None):
+    """Parses an exam from source, the contents of an .exam file or a text
+    stream to read them from. Paths in it are relative to basedir. Raises
+    ExamError if the exam is invalid."""
+    if not isinstance(source, str):
+        source = source.read()
+    return Exam(source.splitlines(True), lazy, basedir, template)
+
+
+def check_exam(lines, basedir="", asts=None):
+    """Parses and validates an exam from the lines of an .exam file
+    without rendering it, going on past every error it can. Besides what
+    parsing finds, this looks for missing images and for Latex modules
+    with bad indents or unbalanced braces. asts are sections parsed
+    before, as for Exam, which need no parsing. Nothing is written, not
+    even the indexes of the banks pools draw from. Returns the ExamErrors
+    found, in order of line."""
+    errors = []
+    try:
+        exam = Exam(lines, lazy=True, basedir=basedir, template="",
+                    asts=asts, errors=errors)
+    except ExamError as e:
+        return sorted_errors(errors + [e])
+    for i in range(len(exam.spans)):
+        try:
+            section = exam.section(i)
+        except ExamError as e:
+            errors.append(e)
+            continue
+        errors += check_content(section.content, basedir)
+    sheet = exam.meta["image sheet"]
+    if sheet and find_image(os.path.join(basedir, sheet)) is None:
+        errors.append(ExamError("Image not found: " + sheet,
+                                lineno=exam.meta_lineno))
+    return sorted_errors(errors)
+
+
+def check_bank(path, lines=None, positions=None):
+    """Validates the question bank at path and every question in it like
+    check_exam, without saving its index. The bank is read from lines (as
+    bytes) instead, if given. If positions is a list, the questions and
+    their parts are collected in it (see Source). Returns the ExamErrors
+    found, in order of line."""
+    errors = []
+    try:
+        bank = Bank(path, errors, lines)
+    except ExamError as e:
+        return sorted_errors(errors + [e])
+    basedir = os.path.dirname(path)
+    section_type = Exam.section_types[bank.type]
+    if lines is None:
+        with open(path, 'rb') as filein:
+            data = filein.read()
+    else:
+        data = b"".join(lines)
+    for offset, size, lineno in zip(bank.offsets, bank.sizes, bank.linenos):
+        lines = data[offset:offset + size].decode().splitlines(True)
+        source = Source(lines, basedir, lineno, errors)
+        source.positions = positions
+        content = gobble_all(Cursor(source, 0, len(source.lines)),
+                             section_type.gobble)
+        errors += check_content(content, basedir)
+    return sorted_errors(errors)
+
+
+def sorted_errors(errors):
+    """Returns errors in order of line, without repeats (e.g. a missing
+    bank, found by every section drawing from it)."""
+    seen = set()
+    unique = []
+    for e in errors:
+        if (e.message, e.context, e.lineno) not in seen:
+            seen.add((e.message, e.context, e.lineno))
+            unique.append(e)
+    return sorted(unique, key=lambda e: e.lineno or 0)
+
+
+def check_file(filename, use_cache=True):
+    """Checks the .exam file or question bank (.bank) at filename without
+    writing anything, loading the sections of an exam that are unchanged
+    since its last transpile rather than parsing them, unless use_cache is
+    False. Returns the ExamErrors found."""
+    filename = os.path.abspath(filename)
+    if filename.endswith(".bank"):
+        return check_bank(filename)
+    filedir = os.path.dirname(filename)
+    saved = use_cache and load_ast(
+        os.path.join(filedir, ".examtex-cache",
+                     os.path.basename(filename) + ".ast"))
+    asts = None
+    if saved:
+        asts = {digest: data for _, digest, data in saved["sections"]
+                if data is not None}
     with open(filename, 'r') as filein:
         lines = filein.readlines()
-    lines = [l for l in lines if l.strip() != ""]
-    exam = Exam(lines)
-    # write to tex files
+    return check_exam(lines, filedir, asts)
+
+
+def report_checks(results, as_json=False, file=None):
+    """Prints the errors check_file found in each file, given as (file
+    name, errors) pairs: one per line as FILE:LINE: message, or as a JSON
+    list of objects with file, line, message and context. Returns the
+    number of errors."""
+    file = file or sys.stdout
+    found = [(name, e) for name, errors in results for e in errors]
+    if as_json:
+        print(json.dumps([{"file": name, "line": e.lineno,
+                           "message": e.message,
+                           "context": e.context and e.context.strip()}
+                          for name, e in found], indent=1), file=file)
+        return len(found)
+    for name, e in found:
+        if e.lineno is None:
+            print("{}: {}".format(name, e.message), file=file)
+        else:
+            print("{}:{}: {}".format(name, e.lineno, e.message), file=file)
+        if e.context:
+            print("\t" + e.context.strip(), file=file)
+    if found:
+        print("{} problem{} found.".format(
+            len(found), "" if len(found) == 1 else "s"), file=file)
+    else:
+        print("No problems found.", file=file)
+    return len(found)
+
+
+def default_seed(filename):
+    """Returns the seed of the exam at filename when none is given, which
+    is derived from the path up to its first dot."""
     match = re.search("\\.", filename)
     if match:
         filename = filename[:match.start()]
-    hashnum = sum(list(map(ord, list(filename))))
-    seed = sys.argv[2] if len(sys.argv) > 2 else hashnum
-    random.seed(seed)
-    qcount = 0
-    exam_tex = exam.to_tex()
-    with open(filename+"-EXAM.tex", 'w+') as fileout:
-        fileout.write(exam_tex)
-    key_tex = exam_tex
-    if exam.meta["answer sheet"]:
-        qcount = 0
-        sheet_tex = exam.ans_sheet_tex()
-        with open(filename+"-ANS_SHEET.tex", 'w+') as fileout:
-            fileout.write(sheet_tex)
-        key_tex = sheet_tex
-    key_tex = re.sub(r"%\\printanswers", r"\\printanswers", key_tex)
-    with open(filename+"-KEY.tex", 'w+') as fileout:
-        fileout.write(key_tex)
-    if exam.meta["image sheet"]:
-        img_tex = exam.image_sheet_tex()
-        with open(filename+"-IMG_SHEET.tex", 'w+') as fileout:
-            fileout.write(img_tex)
-
-
-qcount = 0
-exam = None
-template = ""
-main()
+    return sum(map(ord, filename))
+
+
+def transpile(filename, seed=None, versions=1, shuffle_questions=False,
+              use_cache=True, optimize_images=False, precompile=False,
+              export_key=False, jobs=1, export_ast_json=False, only=None,
+              questions=None, split=1, single_source=False, html=False):
+    """Transpiles the .exam file at filename into tex files next to it,
+    reusing rendered sections from the .examtex-cache directory there
+    unless use_cache is False. If optimize_images, the tex files include
+    copies of the images prepared by an ImageCache. If precompile, they
+    load a format precompiled from their shared preamble (see
+    Exam.meta_tex). If export_key, the answer key of every version is
+    also written to KEY.csv (see key_csv), and if export_ast_json, every
+    version's parsed sections to AST.json (see export_ast). Sections are
+    rendered in jobs processes if jobs > 1. The parsed sections are saved
+    in the cache directory too, and loaded instead of parsed while they
+    are unchanged. If only or questions is given, just PREVIEW.tex is
+    written, with those sections or questions of the first version (see
+    write_preview). If split > 1, the exam and its key are written in up
+    to split parts (0 for one per CPU), to be compiled in parallel and
+    merged (see SplitSink). If single_source, the key is compiled from
+    the exam's tex file rather than written (see write_version). If html,
+    the documents are written as HTML pages instead, without LaTeX (see
+    render_html). Returns the Exam, whose written lists the files
+    written. Raises ExamError if the exam is invalid."""
+    if not 1 <= versions <= 26:
+        compile_error("Number of versions must be between 1 and 26.")
+    filedir = os.path.dirname(os.path.abspath(filename))
+    image_cache = None
+    if optimize_images:
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            compile_error("Optimizing images requires Pillow "
+                          "(pip install Pillow).")
+        image_cache = ImageCache(filedir)
+    if state.metrics:
+        start = time.perf_counter()
+    template = load_template()
+    with open(filename, 'r') as filein:
+        lines = filein.readlines()
+    if state.metrics:
+        state.metrics.add("read", start)
+    cache = None
+    asts = None
+    if use_cache:
+        cache_dir = os.path.join(filedir, ".examtex-cache")
+        with shared_lock:
+            if cache_dir not in caches:
+                caches[cache_dir] = Cache(cache_dir)
+            cache = caches[cache_dir]
+        ast_path = os.path.join(cache_dir, os.path.basename(filename) +
+                                ".ast")
+        saved = load_ast(ast_path)
+        if saved:
+            asts = {digest: data for _, digest, data in saved["sections"]
+                    if data is not None}
+    exam = Exam(lines, lazy=use_cache, basedir=filedir, template=template,
+                asts=asts)
+    exam.precompiled = precompile
+    exam.image_cache = image_cache
+    try:
+        # write to tex files
+        if seed is None:
+            seed = default_seed(filename)
+        match = re.search("\\.", filename)
+        if match:
+            filename = filename[:match.start()]
+        if only or questions:
+            written = [filename+"-PREVIEW.tex"]
+            write_preview(exam, written[0],
+                          version_seeds(seed, versions)[0][1], only,
+                          questions, shuffle_questions, cache)
+        elif html:
+            written, keys = write_html_versions(exam, filename, seed,
+                                                versions, shuffle_questions)
+            if export_key:
+                write_file(filename+"-KEY.csv", key_csv(keys))
+        else:
+            pool = None
+            if jobs > 1:
+                from concurrent.futures import ProcessPoolExecutor
+                pool = ProcessPoolExecutor(jobs)
+            if split == 0:
+                split = os.cpu_count() or 1
+            points = exam.split_points(split) if split > 1 else []
+            try:
+                written, keys = write_versions(exam, filename, seed, versions,
+                                               shuffle_questions, cache, pool,
+                                               points[1:] and points,
+                                               single_source)
+            finally:
+                if pool:
+                    pool.shutdown()
+            if export_key:
+                write_file(filename+"-KEY.csv", key_csv(keys))
+            if export_ast_json:
+                save_ast(export_ast(exam, seed, versions, shuffle_questions),
+                         filename+"-AST.json")
+            if exam.meta["image sheet"]:
+                img_tex = exam.image_sheet_tex()
+                write_file(filename+"-IMG_SHEET.tex", img_tex)
+                written.append(filename+"-IMG_SHEET.tex")
+        if image_cache:
+            image_cache.finish()
+    finally:
+        if image_cache:
+            # the workers are stopped even when a build fails
+            image_cache.close()
+    if cache:
+        if exam.reparsed:
+            os.makedirs(cache_dir, exist_ok=True)
+            save_ast(exam.to_data(), ast_path)
+        cache.evict()
+    exam.written = written
+    return exam
+
+
+def transpile_files(filename, options):
+    """Transpiles filename with the keyword arguments of transpile in
+    options. Returns the tex files written, or the ExamError raised."""
+    try:
+        return transpile(filename, **options).written
+    except ExamError as e:
+        return e
+
+
+def transpile_many(filenames, jobs=1, **options):
+    """Transpiles each of filenames (see transpile for the options) in
+    this process, or in a pool of jobs processes if jobs > 1. An invalid
+    exam does not stop the others. Returns {filename: tex files written,
+    or the ExamError raised}."""
+    if jobs <= 1:
+        return {f: transpile_files(f, options) for f in filenames}
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(jobs) as pool:
+        results = [(f, pool.submit(transpile_files, f, options))
+                   for f in filenames]
+        return {f: job.result() for f, job in results}
+
+
+def main(argv=None):
+    # argparse is only needed on the command line, so it is not imported
+    # by the transpiler itself
+    import argparse
+    parser = argparse.ArgumentParser(description='examtex.py')
+    parser.add_argument("filename")
+    parser.add_argument("seed", nargs="?")
+    parser.add_argument("--versions", type=int, default=1)
+    parser.add_argument("--shuffle-questions", action="store_true")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--optimize-images", action="store_true")
+    parser.add_argument("--precompile", action="store_true")
+    parser.add_argument("--export-key", action="store_true")
+    parser.add_argument("--export-ast", action="store_true")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--split", type=int, nargs="?", const=0,
+                        default=1)
+    parser.add_argument("--single-source", action="store_true")
+    parser.add_argument("--html", action="store_true")
+    parser.add_argument("--only", action="append")
+    parser.add_argument("--questions")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--json", action="store_true")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.check:
+        found = check_file(args.filename, not args.no_cache)
+        if report_checks([(args.filename, found)], args.json):
+            sys.exit(1)
+        return
+    start_metrics(args)
+    try:
+        questions = args.questions and question_range(args.questions)
+        transpile(args.filename, args.seed, args.versions,
+                  args.shuffle_questions, not args.no_cache,
+                  args.optimize_images, args.precompile, args.export_key,
+                  args.jobs, args.export_ast, args.only, questions,
+                  args.split, args.single_source, args.html)
+    except ExamError as e:
+        report_error(e)
+        sys.exit(1)
+    report_metrics(args)
+
+
+template_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "template.tex")
+# template contents by path: (mtime, contents)
+templates = {}
+# what the build in each thread records (see BuildState)
+state = BuildState()
+# Cache objects by directory, kept for the life of the process
+caches = {}
+# Bank objects by path
+banks = {}
+# held while templates, caches or banks are looked up or added, since
+# builds running concurrently share them
+shared_lock = threading.Lock()
+if __name__ == "__main__":
+    main()
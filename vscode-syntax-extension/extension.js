@@ -0,0 +1,27 @@
+// Starts examlsp.py, the language server in the latex-exam repository,
+// for .exam files and question banks.
+const vscode = require("vscode");
+const { LanguageClient } = require("vscode-languageclient/node");
+
+let client;
+
+function activate(context) {
+    const config = vscode.workspace.getConfiguration("exam");
+    const server = config.get("languageServer.path");
+    if (!server) {
+        return;
+    }
+    client = new LanguageClient("exam", "exam language server", {
+        command: config.get("languageServer.python"),
+        args: [server]
+    }, {
+        documentSelector: [{ scheme: "file", language: "exam" }]
+    });
+    client.start();
+}
+
+function deactivate() {
+    return client ? client.stop() : undefined;
+}
+
+module.exports = { activate, deactivate };